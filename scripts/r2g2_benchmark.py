@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""Benchmark r2g2_on_package.py against synthetic R packages of controlled size and shape.
+
+Each scenario builds and installs a throwaway R package into a temporary library,
+runs the generator on it and appends one JSON record per run to the results file,
+so that runs on different commits can be compared."""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+GENERATOR = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'r2g2_on_package.py' )
+
+# R default value written for each default type
+DEFAULT_VALUES = {
+    'integer': '1L', # INTSXP
+    'logical': 'TRUE', # LGLSXP
+    'double': '0.5', # REALSXP
+    'character': '"value"', # STRSXP
+    'NULL': 'NULL', # NILSXP
+    'none': None, # no default, the empty symbol
+    'ellipsis': None, # a trailing ..., counted as one of the formals
+}
+
+DESCRIPTION = '''Package: %(package)s
+Version: 0.0.1
+Title: Synthetic Package for R2-G2 Benchmarks
+Description: Throwaway package generated by r2g2_benchmark.py.
+Author: R2-G2
+Maintainer: R2-G2 <r2g2@example.org>
+License: MIT
+'''
+
+RD_TEMPLATE = '''\\name{%(name)s}
+\\alias{%(name)s}
+\\title{Synthetic function %(name)s}
+\\description{
+%(description)s
+}
+\\usage{%(usage)s}
+\\arguments{
+%(arguments)s
+}
+\\value{NULL}
+'''
+
+
+def get_formals( n_formals, default_types ):
+    """R formals for a synthetic function, cycling through default_types."""
+    has_ellipsis = 'ellipsis' in default_types and n_formals > 0
+    default_types = [ default_type for default_type in default_types if default_type != 'ellipsis' ] or [ 'none' ]
+    formals = []
+    for i, default_type in zip( range( n_formals - int( has_ellipsis ) ), itertools.cycle( default_types ) ):
+        value = DEFAULT_VALUES[default_type]
+        if value is None:
+            formals.append( 'arg_%i' % ( i ) )
+        else:
+            formals.append( 'arg_%i = %s' % ( i, value ) )
+    if has_ellipsis:
+        formals.append( '...' )
+    return formals
+
+
+def build_package( package_dir, package, n_functions, n_formals, default_types, help_lines ):
+    """Write the sources of a synthetic package with n_functions exported functions."""
+    for subdir in ( 'R', 'man' ):
+        os.makedirs( os.path.join( package_dir, subdir ) )
+    with open( os.path.join( package_dir, 'DESCRIPTION' ), 'w' ) as out:
+        out.write( DESCRIPTION % dict( package=package ) )
+    names = [ 'fn_%i' % ( i ) for i in range( n_functions ) ]
+    with open( os.path.join( package_dir, 'NAMESPACE' ), 'w' ) as out:
+        for name in names:
+            out.write( 'export(%s)\n' % ( name ) )
+    formals = get_formals( n_formals, default_types )
+    signature = ', '.join( formals )
+    with open( os.path.join( package_dir, 'R', 'functions.R' ), 'w' ) as out:
+        for name in names:
+            out.write( '%s <- function(%s) invisible(NULL)\n' % ( name, signature ) )
+    arguments = '\n'.join( '\\item{%s}{Argument %s of the function.}' % ( formal.split( ' ' )[0], formal.split( ' ' )[0] ) for formal in formals )
+    description = '\n'.join( 'Line %i of the synthetic help page, long enough to look like real documentation.' % ( i ) for i in range( help_lines ) )
+    for name in names:
+        with open( os.path.join( package_dir, 'man', '%s.Rd' % ( name ) ), 'w' ) as out:
+            out.write( RD_TEMPLATE % dict( name=name, description=description, usage='%s(%s)' % ( name, signature ), arguments=arguments ) )
+
+
+def install_package( package_dir, library ):
+    subprocess.check_call( [ 'R', 'CMD', 'INSTALL', '--no-test-load', '-l', library, package_dir ],
+                           stdout=subprocess.DEVNULL )
+
+
+def run_generator( package, library, out_dir, generator_args ):
+    """Run the generator in a child process; returns ( exit code, wall time, peak RSS in KB )."""
+    env = dict( os.environ )
+    env['R_LIBS'] = os.pathsep.join( filter( None, [ library, env.get( 'R_LIBS' ) ] ) )
+    cmd = [ sys.executable, GENERATOR, '--name', package, '--out', out_dir ] + generator_args
+    start = time.time()
+    proc = subprocess.Popen( cmd, env=env, stdout=subprocess.DEVNULL )
+    returncode, peak_rss = wait_for_process( proc )
+    return returncode, time.time() - start, peak_rss
+
+
+def wait_for_process( proc, timeout=None ):
+    """Wait for a child process, killed once timeout seconds have passed; returns ( exit code, peak RSS in KB ).
+
+    wait4 reports the peak RSS of the child, or of its largest reaped descendant (e.g. --jobs workers, or Rscript under a shell)."""
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        pid, status, rusage = os.wait4( proc.pid, os.WNOHANG if deadline else 0 )
+        if pid:
+            break
+        if time.time() > deadline:
+            proc.kill()
+            deadline = None
+        time.sleep( 0.01 )
+    proc.returncode = os.waitstatus_to_exitcode( status )
+    peak_rss = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss = peak_rss // 1024 # bytes there, KB on Linux
+    return proc.returncode, peak_rss
+
+
+def get_output_size( out_dir ):
+    total = 0
+    count = 0
+    for name in os.listdir( out_dir ):
+        if name.endswith( '.xml' ) and not name.endswith( '_macros.xml' ):
+            total += os.path.getsize( os.path.join( out_dir, name ) )
+            count += 1
+    return count, total
+
+
+def get_commit():
+    try:
+        return subprocess.check_output( [ 'git', 'rev-parse', 'HEAD' ], cwd=os.path.dirname( GENERATOR ),
+                                        stderr=subprocess.DEVNULL ).decode().strip()
+    except ( OSError, subprocess.CalledProcessError ):
+        return None
+
+
+def get_r_version():
+    try:
+        return subprocess.check_output( [ 'Rscript', '-e', 'cat(R.version.string)' ], stderr=subprocess.DEVNULL ).decode().strip()
+    except ( OSError, subprocess.CalledProcessError ):
+        return None
+
+
+def int_list( value ):
+    return [ int( x ) for x in value.split( ',' ) ]
+
+
+def main():
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n' )[0] )
+    parser.add_argument("--functions", help="Comma separated numbers of exported functions, one scenario each", type=int_list, default=[ 100 ])
+    parser.add_argument("--formals", help="Comma separated numbers of formals per function, one scenario each", type=int_list, default=[ 10 ])
+    parser.add_argument("--default_types", help="Comma separated default value types to cycle through: %s" % ( ', '.join( sorted( DEFAULT_VALUES ) ) ), default='integer,logical,double,character,NULL,none,ellipsis')
+    parser.add_argument("--help_lines", help="Lines of description in each help page", type=int, default=20)
+    parser.add_argument("--repeat", help="Runs of the generator per scenario", type=int, default=3)
+    parser.add_argument("--generator_args", help="Extra arguments passed to r2g2_on_package.py, e.g. --generator_args='--jobs 4'", default='')
+    parser.add_argument("--label", help="Free text label stored with each record", default='')
+    parser.add_argument("--output", help="JSON lines file the results are appended to", default='r2g2_benchmark.jsonl')
+    parser.add_argument("--keep", help="Keep the temporary packages and outputs", action='store_true')
+    args = parser.parse_args()
+
+    default_types = args.default_types.split( ',' )
+    for default_type in default_types:
+        if default_type not in DEFAULT_VALUES:
+            parser.error( "unknown default type: %s" % ( default_type ) )
+    generator_args = args.generator_args.split()
+    commit = get_commit()
+    r_version = get_r_version()
+
+    work_dir = tempfile.mkdtemp( prefix='r2g2_benchmark_' )
+    try:
+        library = os.path.join( work_dir, 'library' )
+        os.makedirs( library )
+        for i, ( n_functions, n_formals ) in enumerate( itertools.product( args.functions, args.formals ) ):
+            package = 'r2g2bench%i' % ( i )
+            package_dir = os.path.join( work_dir, package )
+            print('Building', package, 'with', n_functions, 'functions of', n_formals, 'formals')
+            build_package( package_dir, package, n_functions, n_formals, default_types, args.help_lines )
+            install_package( package_dir, library )
+            for run in range( args.repeat ):
+                out_dir = os.path.join( work_dir, 'out_%s_%i' % ( package, run ) )
+                returncode, wall, peak_rss = run_generator( package, library, out_dir, generator_args )
+                n_tools, xml_bytes = get_output_size( out_dir ) if os.path.isdir( out_dir ) else ( 0, 0 )
+                record = dict( timestamp=time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+                               commit=commit,
+                               label=args.label,
+                               python=platform.python_version(),
+                               r=r_version,
+                               generator_args=args.generator_args,
+                               functions=n_functions,
+                               formals=n_formals,
+                               default_types=default_types,
+                               help_lines=args.help_lines,
+                               run=run,
+                               returncode=returncode,
+                               wall_seconds=round( wall, 4 ),
+                               peak_rss_kb=peak_rss,
+                               functions_per_second=round( n_functions / wall, 4 ),
+                               tools=n_tools,
+                               xml_bytes=xml_bytes )
+                print('%(functions)i functions x %(formals)i formals, run %(run)i: %(wall_seconds).2fs, %(peak_rss_kb)i KB, %(functions_per_second).1f functions/s' % record)
+                with open( args.output, 'a' ) as out:
+                    out.write( '%s\n' % ( json.dumps( record, sort_keys=True ) ) )
+                if not args.keep:
+                    shutil.rmtree( out_dir, ignore_errors=True )
+    finally:
+        if args.keep:
+            print('Kept', work_dir)
+        else:
+            shutil.rmtree( work_dir, ignore_errors=True )
+
+
+if __name__ == '__main__':
+    main()
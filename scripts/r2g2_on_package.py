@@ -4,22 +4,30 @@
 """A script to convert R library functions to Galaxy Tools."""
 
 import argparse
+import collections
+import contextlib
+import cProfile
+import csv
+import fnmatch
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import multiprocessing
+import multiprocessing.connection
 import os
+import pstats
+import queue
+import shlex
+import shutil
 import string
+import tarfile
+import tempfile
+import threading
+import time
 
-import rpy2.robjects.packages as rpackages
-from rpy2 import robjects
-from rpy2.robjects.functions import DocumentedSTFunction
-from rpy2.robjects.help import pages
-from rpy2.robjects.vectors import BoolVector, IntVector, FloatVector, StrVector, ListVector
-from xml.sax.saxutils import quoteattr
-from rpy2.rinterface import str_typeint
-
-package_name = None
-package_version = None
-r_name = None
-galaxy_tool_version = None
-
+from xml.sax.saxutils import escape, quoteattr
 
 tool_xml ='''<tool id="%(id)s" name="%(name)s" version="@VERSION@-%(galaxy_tool_version)s">
     <description><![CDATA[%(description)s]]></description>
@@ -33,6 +41,7 @@ tool_xml ='''<tool id="%(id)s" name="%(name)s" version="@VERSION@-%(galaxy_tool_
         #if "output_r_script" in str( $include_outputs ).split( "," ):
             cp '${%(id_underscore)s_script}' '${output_r_script}' &&
         #end if
+        @GALAXY_SLOTS_ENV@
         Rscript '${%(id_underscore)s_script}'
     ]]>
     </command>
@@ -44,9 +53,11 @@ tool_xml ='''<tool id="%(id)s" name="%(name)s" version="@VERSION@-%(galaxy_tool_
     </configfiles>
     <inputs>
 %(inputs)s
+        <expand macro="params_rds_serialization" />
         <param name="include_outputs" type="select" multiple="True" label="Datasets to create">
             <option value="output_r_dataset" selected="true">Results in RDS format</option>
             <option value="output_r_script" selected="false">R script</option>
+            <option value="output_metrics" selected="false">Run time and memory metrics</option>
         </param>
     </inputs>
     <outputs>
@@ -55,6 +66,9 @@ tool_xml ='''<tool id="%(id)s" name="%(name)s" version="@VERSION@-%(galaxy_tool_
         </data>
         <data format="txt" name="output_r_script" label="${tool.name} on ${on_string} (Rscript)">
             <filter>"output_r_script" in include_outputs</filter>
+        </data>
+        <data format="tabular" name="output_metrics" label="${tool.name} on ${on_string} (metrics)">
+            <filter>"output_metrics" in include_outputs</filter>
         </data>%(outputs)s
     </outputs>
     <help><![CDATA[
@@ -194,7 +208,75 @@ ellipsis_input = '''
         </repeat>
 ''' % dict( input_not_determined=input_not_determined, name='argument' ) % dict( list(INPUT_NOT_DETERMINED_PASS_DICT.items()) + list(dict( name='argument', label='"Argument value"', help='""', value='""'  ).items()) )
 
-def generate_macro_xml():
+# Formals setting the parallelism of a function; defaulted to the cores Galaxy allocates to the job
+SLOTS_FORMALS = [ 'cores', 'mc.cores', 'ncores', 'n.cores', 'nCores', 'threads', 'nthreads', 'n.threads', 'num.threads', 'numThreads', 'ncpus' ]
+BPPARAM_FORMALS = [ 'BPPARAM' ]
+
+slots_input = '''
+        <conditional name="%(name)s_type">
+            <param name="%(name)s_type_selector" type="select" label="%(name)s: parallelism" help=%(help)s>
+                <option value="slots" selected="true">Cores allocated to the job</option>
+                <option value="integer">Number of cores</option>
+                <option value="skip">Function default</option>
+            </param>
+            <when value="slots">
+                <!-- Do nothing here -->
+            </when>
+            <when value="integer">
+                <param name="%(name)s" type="integer" value="1" min="1" label=%(label)s/>
+            </when>
+            <when value="skip">
+                <!-- Do nothing here -->
+            </when>
+        </conditional>
+'''
+
+# --compact_xml tools expand these input templates from the macros file instead of inlining them
+INPUT_MACROS = [ ( 'r2g2_optional_input_dataset', optional_input_dataset ),
+                 ( 'r2g2_optional_input_text', optional_input_text ),
+                 ( 'r2g2_optional_input_boolean', optional_input_boolean ),
+                 ( 'r2g2_optional_input_integer', optional_input_integer ),
+                 ( 'r2g2_optional_input_float', optional_input_float ),
+                 ( 'r2g2_optional_input_select', optional_input_select ),
+                 ( 'r2g2_optional_input_not_determined', optional_input_not_determined ),
+                 ( 'r2g2_ellipsis_input', ellipsis_input ),
+                 ( 'r2g2_slots_input', slots_input ) ]
+INPUT_MACRO_NAMES = dict( ( template, macro_name ) for macro_name, template in INPUT_MACROS )
+INPUT_MACRO_ATTRIBUTES = [ 'name', 'label', 'help', 'value' ]
+INPUT_MACRO_TOKENS = dict( name='@NAME@', label='"@LABEL@"', help='"@HELP@"', value='"@VALUE@"' )
+for select in INPUT_NOT_DETERMINED_DICT:
+    INPUT_MACRO_TOKENS[select] = '@%s@' % ( select.upper() )
+
+input_macro = '''    <xml name="%(name)s"%(tokens)s>%(body)s    </xml>
+'''
+
+def generate_input_macros():
+    """The parameterized <xml> macros of INPUT_MACROS; tokens not passed by an expand default to "False"."""
+    macros = []
+    for macro_name, template in INPUT_MACROS:
+        tokens = [ key for key in INPUT_MACRO_ATTRIBUTES if '%%(%s)s' % ( key ) in template ]
+        tokens = ' tokens="%s"' % ( ",".join( tokens ) ) if tokens else ''
+        tokens += ''.join( ' token_%s="False"' % ( select ) for select in sorted( INPUT_NOT_DETERMINED_DICT ) if '%%(%s)s' % ( select ) in template )
+        macros.append( input_macro % dict( name=macro_name, tokens=tokens, body=template % INPUT_MACRO_TOKENS ) )
+    return '\n'.join( macros )
+
+
+def render_input_expand( input_template, input_dict ):
+    """The <expand> of the INPUT_MACROS macro for input_template, equivalent to input_template % input_dict."""
+    attributes = [ 'macro="%s"' % ( INPUT_MACRO_NAMES[input_template] ) ]
+    for key in INPUT_MACRO_ATTRIBUTES:
+        if '%%(%s)s' % ( key ) in input_template:
+            attributes.append( '%s=%s' % ( key, input_dict[key] if key != 'name' else quoteattr( input_dict[key] ) ) )
+    for select in sorted( INPUT_NOT_DETERMINED_DICT ):
+        if '%%(%s)s' % ( select ) in input_template and input_dict[select]:
+            attributes.append( '%s="%s"' % ( select, input_dict[select] ) )
+    return '<expand %s/>' % ( ' '.join( attributes ) )
+
+RDS_VERSIONS = [ 2, 3 ]
+RDS_COMPRESSIONS = [ 'none', 'gzip', 'bzip2', 'xz' ]
+RDS_COMPRESSION_LEVELS = list( range( 1, 10 ) )
+
+def generate_macro_xml( package_info ):
     macro_xml = '''<macros>
     <xml name="requirements">
         <requirements>
@@ -219,36 +301,456 @@ def generate_macro_xml():
         <param name="species_column" label="Group name column" type="data_column" data_ref="input_abundance" value="6" help="Species, phylum, etc"/>
         <param name="sample_columns" label="Sample count columns" type="data_column" multiple="True" value="2" data_ref="input_abundance" help="Select each column that contains counts"/>
         <param name="header" type="boolean" truevalue="TRUE" falsevalue="FALSE" checked="False" label="Input has a header line"/>
+        <param name="sparse" type="boolean" truevalue="TRUE" falsevalue="FALSE" checked="False" label="Store as a sparse matrix" help="Saves memory and disk space when most counts are zero"/>
     </xml>
 
     <token name="@RSCRIPT_LOAD_TABULAR_FILE@"><![CDATA[
 #set $int_species_column = int( str( $species_column ) )
-#set $fixed_sample_columns = []
+#set $int_sample_columns = []
 #for $sample_col in map( int, str( $sample_columns ).split( "," ) ):
 #assert $sample_col != $int_species_column, "Sample label column and sample count columns must not be the same."
-#silent $fixed_sample_columns.append( str( $sample_col if $sample_col < $int_species_column else $sample_col-1 ) )
+#silent $int_sample_columns.append( str( $sample_col ) )
 #end for
 options(bitmapType='cairo')## No X11, so we'll use cairo
-library(%(r_name)s)
-input_abundance <- read.table("${input_abundance}", sep="\t", row.names=${ species_column }, header=${header} )
-input_abundance <- t( input_abundance[ c( ${ ",".join( $fixed_sample_columns ) } )] )
+r2g2_timed( "library", "%(r_name)s", library(%(r_name)s) )
+r2g2_load_tabular_file <- function( path, species_column, sample_columns, header, sparse ) {
+    ## Only the label and count columns are read, in file order, with their types declared up front
+    columns <- sort( c( species_column, sample_columns ) )
+    magic <- readBin( path, "raw", n = 2L )
+    gzipped <- length( magic ) == 2L && magic[1] == as.raw( 0x1f ) && magic[2] == as.raw( 0x8b )
+    if ( requireNamespace( "data.table", quietly = TRUE ) ) {
+        input <- if ( gzipped ) list( cmd = paste( "gzip -dc", shQuote( path ) ) ) else list( file = path )
+        data <- do.call( data.table::fread, c( input, list( sep = "\t", header = header, select = columns,
+                                                              colClasses = list( character = species_column, numeric = sample_columns ),
+                                                              data.table = FALSE, showProgress = FALSE ) ) )
+    } else {
+        ## file() decompresses gzip transparently
+        n_columns <- length( strsplit( readLines( path, n = 1L ), "\t", fixed = TRUE )[[1]] )
+        col_classes <- rep( "NULL", n_columns )
+        col_classes[species_column] <- "character"
+        col_classes[sample_columns] <- "numeric"
+        data <- read.table( path, sep = "\t", header = header, colClasses = col_classes )
+    }
+    names( data ) <- if ( header ) make.names( names( data ), unique = TRUE ) else paste0( "V", columns )
+    data <- data[ match( c( species_column, sample_columns ), columns ) ]
+    labels <- data[[1]]
+    counts <- data[-1]
+    if ( sparse ) {
+        nonzero <- lapply( counts, function( x ) which( x != 0 | is.na( x ) ) )
+        return( Matrix::sparseMatrix( i = rep( seq_along( counts ), lengths( nonzero ) ),
+                                      j = unlist( nonzero, use.names = FALSE ),
+                                      x = unlist( mapply( function( x, i ) x[i], counts, nonzero, SIMPLIFY = FALSE ), use.names = FALSE ),
+                                      dims = c( length( counts ), length( labels ) ),
+                                      dimnames = list( names( counts ), labels ) ) )
+    }
+    ## Bind the count columns as the rows of the matrix in one allocation, instead of transposing a copy
+    rval <- do.call( rbind, unname( as.list( counts ) ) )
+    dimnames( rval ) <- list( names( counts ), labels )
+    rval
+}
+input_abundance <- r2g2_timed( "read", "input_abundance", r2g2_load_tabular_file( "${input_abundance}", ${int_species_column}L, c( ${ "L, ".join( $int_sample_columns ) }L ), ${header}, ${sparse} ) )
+r2g2_metric( "object_size", "input_abundance", bytes = as.numeric( object.size( input_abundance ) ) )
+]]>
+    </token>
+
+    <xml name="params_rds_serialization">
+        <section name="rds_options" title="RDS serialization" expanded="false">
+            <param name="rds_version" type="select" label="Serialization format version" help="Version 3 (R 3.5 or later) keeps ALTREP compact representations">
+                <option value="default" selected="true">Default (%(rds_version)s)</option>
+                <option value="2">2</option>
+                <option value="3">3</option>
+            </param>
+            <param name="rds_compress" type="select" label="Compression" help="Less compression is faster to write and read, but takes more disk space">
+                <option value="default" selected="true">Default (%(rds_compress)s)</option>
+                <option value="none">None</option>
+                <option value="gzip">gzip</option>
+                <option value="bzip2">bzip2</option>
+                <option value="xz">xz</option>
+            </param>
+            <param name="rds_compression_level" type="select" label="Compression level">
+                <option value="default" selected="true">Default (%(rds_compression_level)s)</option>
+%(rds_compression_level_options)s
+            </param>
+        </section>
+    </xml>
+
+    <token name="@RSCRIPT_SAVE_RDS@"><![CDATA[
+#set $rds_version = str( $rds_options.rds_version )
+#if $rds_version == "default":
+    #set $rds_version = "%(rds_version)s"
+#end if
+#set $rds_compress = str( $rds_options.rds_compress )
+#if $rds_compress == "default":
+    #set $rds_compress = "%(rds_compress)s"
+#end if
+#set $rds_compression_level = str( $rds_options.rds_compression_level )
+#if $rds_compression_level == "default":
+    #set $rds_compression_level = "%(rds_compression_level)s"
+#end if
+r2g2_save_rds <- function( object, file ) {
+    con <- switch( "${rds_compress}",
+                   none = file( file, "wb" ),
+                   gzip = gzfile( file, "wb", compression = ${rds_compression_level} ),
+                   bzip2 = bzfile( file, "wb", compression = ${rds_compression_level} ),
+                   xz = xzfile( file, "wb", compression = ${rds_compression_level} ) )
+    on.exit( close( con ) )
+    saveRDS( object, file = con, ascii = FALSE, version = ${rds_version} )
+}
+]]>
+    </token>
+
+    <token name="@GALAXY_SLOTS_ENV@"><![CDATA[export OMP_NUM_THREADS=\\${GALAXY_SLOTS:-1} OPENBLAS_NUM_THREADS=\\${GALAXY_SLOTS:-1} MKL_NUM_THREADS=\\${GALAXY_SLOTS:-1} VECLIB_MAXIMUM_THREADS=\\${GALAXY_SLOTS:-1} R_DATATABLE_NUM_THREADS=\\${GALAXY_SLOTS:-1} BIOCPARALLEL_WORKER_NUMBER=\\${GALAXY_SLOTS:-1} &&]]></token>
+
+    <token name="@RSCRIPT_GALAXY_SLOTS@"><![CDATA[
+r2g2_slots <- suppressWarnings( as.integer( Sys.getenv( "GALAXY_SLOTS", "1" ) ) )
+if ( is.na( r2g2_slots ) || r2g2_slots < 1L ) r2g2_slots <- 1L
+options( mc.cores = r2g2_slots, Ncpus = r2g2_slots )
+r2g2_bpparam <- function( workers ) {
+    if ( workers > 1L ) BiocParallel::MulticoreParam( workers = workers ) else BiocParallel::SerialParam()
+}
+]]>
+    </token>
+
+    <token name="@RSCRIPT_METRICS_START@"><![CDATA[
+#if "output_metrics" in str( $include_outputs ).split( "," ):
+r2g2_metrics_enabled <- TRUE
+invisible( gc( reset = TRUE ) )
+#else
+r2g2_metrics_enabled <- FALSE
+#end if
+r2g2_metrics_rows <- list()
+## Arguments are only evaluated when metrics are recorded, e.g. object.size() of large objects
+r2g2_metric <- function( step, name, seconds = NA, bytes = NA, value = NA ) {
+    if ( r2g2_metrics_enabled ) {
+        r2g2_metrics_rows[[ length( r2g2_metrics_rows ) + 1L ]] <<- data.frame( step = step, name = name, seconds = seconds, bytes = bytes, value = as.character( value ), stringsAsFactors = FALSE )
+    }
+    invisible( NULL )
+}
+## expr is a promise, evaluated (and timed) here
+r2g2_timed <- function( step, name, expr ) {
+    start <- proc.time()[[ "elapsed" ]]
+    value <- expr
+    r2g2_metric( step, name, seconds = proc.time()[[ "elapsed" ]] - start )
+    value
+}
+]]>
+    </token>
+
+    <token name="@RSCRIPT_INPUTS@"><![CDATA[
+r2g2_read_rds <- function( name, file ) {
+    value <- r2g2_timed( "readRDS", name, readRDS( file ) )
+    r2g2_metric( "object_size", name, bytes = as.numeric( object.size( value ) ) )
+    value
+}
+## Binds variable to a promise reading file, and records the file of each bound variable
+r2g2_bound_files <- character( 0 )
+r2g2_bind_rds <- function( variable, name, file ) {
+    r2g2_bound_files[[ variable ]] <<- file
+    delayedAssign( variable, r2g2_read_rds( name, file ), assign.env = globalenv() )
+}
+]]>
+    </token>
+
+    <token name="@RSCRIPT_CACHE@"><![CDATA[
+## Results are cached in R2G2_CACHE_DIR, or else the directory below; an empty directory disables the cache
+r2g2_cache_dir <- Sys.getenv( "R2G2_CACHE_DIR", %(cache_dir_string)s )
+r2g2_cache_max_bytes <- %(cache_max_size)s * 1024^2
+## md5 of everything the result depends on: the call as written, the versions, the serialization options and the content of the input files it uses
+r2g2_cache_key <- function( call, options ) {
+    if ( !nzchar( r2g2_cache_dir ) ) return( NA_character_ )
+    files <- r2g2_bound_files[ intersect( sort( all.names( call ) ), names( r2g2_bound_files ) ) ]
+    key_file <- tempfile()
+    on.exit( unlink( key_file ) )
+    writeLines( c( "%(package_version)s", as.character( packageVersion( "%(r_name)s" ) ), R.version.string, options,
+                   deparse( call ), names( files ), unname( tools::md5sum( files ) ) ), key_file )
+    unname( tools::md5sum( key_file ) )
+}
+## Links, or copies, the cached result of key to file; returns FALSE on a miss
+r2g2_cache_fetch <- function( key, file ) {
+    if ( is.na( key ) ) return( FALSE )
+    cached <- file.path( r2g2_cache_dir, paste0( key, ".rds" ) )
+    hit <- tryCatch( {
+        file.exists( cached ) && {
+            unlink( file )
+            suppressWarnings( file.link( cached, file ) ) || file.copy( cached, file, overwrite = TRUE )
+        }
+    }, error = function( e ) FALSE )
+    if ( hit ) {
+        ## The modification time orders the cached results for eviction, least recently used first
+        try( Sys.setFileTime( cached, Sys.time() ), silent = TRUE )
+    }
+    cat( "r2g2 cache:", if ( hit ) "hit" else "miss", key, "\\n" )
+    r2g2_metric( "cache", if ( hit ) "hit" else "miss", value = key )
+    hit
+}
+r2g2_cache_store <- function( key, file ) {
+    if ( is.na( key ) ) return( invisible( FALSE ) )
+    tryCatch( {
+        dir.create( r2g2_cache_dir, recursive = TRUE, showWarnings = FALSE )
+        ## Copied under a temporary name and renamed, so concurrent jobs never read a partial file
+        tmp <- tempfile( tmpdir = r2g2_cache_dir, fileext = ".tmp" )
+        if ( file.copy( file, tmp ) && file.rename( tmp, file.path( r2g2_cache_dir, paste0( key, ".rds" ) ) ) ) {
+            cat( "r2g2 cache: stored", key, "\\n" )
+        }
+        unlink( tmp )
+        r2g2_cache_evict()
+    }, error = function( e ) message( "r2g2 cache: not stored: ", conditionMessage( e ) ) )
+    invisible( TRUE )
+}
+r2g2_cache_evict <- function() {
+    cached <- file.info( list.files( r2g2_cache_dir, pattern = "[.]rds$", full.names = TRUE ) )
+    cached <- cached[ order( cached[[ "mtime" ]], decreasing = TRUE ), , drop = FALSE ]
+    evicted <- rownames( cached )[ cumsum( cached[[ "size" ]] ) > r2g2_cache_max_bytes ]
+    if ( length( evicted ) ) {
+        unlink( evicted )
+        cat( "r2g2 cache: evicted", length( evicted ), "results\\n" )
+    }
+}
+]]>
+    </token>
+
+    <token name="@RSCRIPT_METRICS_END@"><![CDATA[
+#if "output_metrics" in str( $include_outputs ).split( "," ):
+## The last column of gc() is the maximum used since the gc( reset = TRUE ) at the start, in Mb
+r2g2_metrics_memory <- gc()
+r2g2_metric( "memory", "Ncells max used", bytes = r2g2_metrics_memory[ "Ncells", ncol( r2g2_metrics_memory ) ] * 1024^2 )
+r2g2_metric( "memory", "Vcells max used", bytes = r2g2_metrics_memory[ "Vcells", ncol( r2g2_metrics_memory ) ] * 1024^2 )
+r2g2_metrics_time <- proc.time()
+r2g2_metric( "total", "elapsed", seconds = r2g2_metrics_time[[ "elapsed" ]] )
+r2g2_metric( "total", "user", seconds = r2g2_metrics_time[[ "user.self" ]] )
+r2g2_metric( "total", "system", seconds = r2g2_metrics_time[[ "sys.self" ]] )
+r2g2_metrics_session <- sessionInfo()
+r2g2_metric( "session", "R", value = r2g2_metrics_session[[ "R.version" ]][[ "version.string" ]] )
+r2g2_metric( "session", "platform", value = r2g2_metrics_session[[ "platform" ]] )
+for ( r2g2_metrics_package in c( r2g2_metrics_session[[ "otherPkgs" ]], r2g2_metrics_session[[ "loadedOnly" ]] ) ) {
+    r2g2_metric( "session", r2g2_metrics_package[[ "Package" ]], value = r2g2_metrics_package[[ "Version" ]] )
+}
+write.table( do.call( rbind, r2g2_metrics_rows ), file = "${output_metrics}", sep = "\t", quote = FALSE, row.names = FALSE, na = "" )
+#end if
+]]>
+    </token>
+
+%(input_macros)s
+    <token name="@RSCRIPT_ARGUMENT_DEF@"><![CDATA[
+#def r2g2_argument( $name, $conditional, $param, $variable )
+#set $selector = str( $conditional[$param + '_type_selector'] )
+#if $selector == 'dataset':
+$name = $variable
+#elif $selector == 'text':
+$name = "${conditional[$param]}"
+#elif $selector in [ 'integer', 'float', 'boolean' ]:
+$name = ${conditional[$param]}
+#elif $selector == 'select':
+#raise ValueError( 'not implemented' )
+#elif $selector == 'NULL':
+$name = NULL
+#end if
+#end def
 ]]>
     </token>
 
     <token name="@VERSION@">%(package_version)s</token>
 
-</macros>''' % dict( package_name=package_name, package_version=package_version, r_name=r_name, galaxy_tool_version=galaxy_tool_version )
+</macros>''' % dict( package_info, input_macros=generate_input_macros(), cache_dir_string=json.dumps( package_info.get( 'cache_dir' ) or '' ), rds_compression_level_options="\n".join( '                <option value="%i">%i</option>' % ( level, level ) for level in RDS_COMPRESSION_LEVELS ) )
     return macro_xml
 
 CONFIG_SPLIT_DESIRED_OUTPUTS = '''#set $include_files = str( $include_outputs ).split( "," )'''
 
 SAVE_R_OBJECT_TEXT = '''
 #if "output_r_dataset" in $include_files:
-    saveRDS(rval, file = "${output_r_dataset}", ascii = FALSE, version = 2, compress = TRUE )
+@RSCRIPT_SAVE_RDS@
+    r2g2_timed( "saveRDS", "rval", r2g2_save_rds( rval, "${output_r_dataset}" ) )
+    r2g2_metric( "file_size", "output_r_dataset", bytes = file.size( "${output_r_dataset}" ) )
+#end if
+'''
+
+# Rscript fragments, appended once per input by render_rscript()
+RSCRIPT_HEADER = CONFIG_SPLIT_DESIRED_OUTPUTS + '''
+@RSCRIPT_METRICS_START@
+@RSCRIPT_INPUTS@
+@RSCRIPT_GALAXY_SLOTS@
+r2g2_timed( "library", "%(r_name)s", library(%(r_name)s) )'''
+
+RSCRIPT_CALL_START = '''
+#set $___USE_COMMA___ = ""
+rval <- r2g2_timed( "call", %(rname_string)s, %(rname)s('''
+
+# With --cache_dir, the call is quoted first, and only evaluated when its result is not in the cache
+RSCRIPT_CACHED_CALL_START = '''
+@RSCRIPT_CACHE@
+#set $___USE_COMMA___ = ""
+r2g2_call <- quote( %(rname)s('''
+
+RSCRIPT_CACHED_CALL_END = '''
+) )
+#if "output_r_dataset" in $include_files:
+@RSCRIPT_SAVE_RDS@
+r2g2_key <- r2g2_cache_key( r2g2_call, "${rds_version} ${rds_compress} ${rds_compression_level}" )
+r2g2_cache_hit <- r2g2_cache_fetch( r2g2_key, "${output_r_dataset}" )
+#else
+r2g2_cache_hit <- FALSE
+#end if
+if ( !r2g2_cache_hit ) {
+rval <- r2g2_timed( "call", %(rname_string)s, eval( r2g2_call ) )
+r2g2_metric( "object_size", "rval", bytes = as.numeric( object.size( rval ) ) )'''
+
+RSCRIPT_CACHED_FOOTER = '''
+#if "output_r_dataset" in $include_files:
+    r2g2_timed( "saveRDS", "rval", r2g2_save_rds( rval, "${output_r_dataset}" ) )
+    r2g2_cache_store( r2g2_key, "${output_r_dataset}" )
+#end if
+}
+#if "output_r_dataset" in $include_files:
+r2g2_metric( "file_size", "output_r_dataset", bytes = file.size( "${output_r_dataset}" ) )
+#end if
+@RSCRIPT_METRICS_END@
+'''
+
+RSCRIPT_OPTIONAL_START = '''
+#if str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type_selector ) == "True":
+'''
+
+RSCRIPT_OPTIONAL_END = '''
+#end if
+'''
+
+RSCRIPT_OPTIONAL_ARGUMENT = dict(
+    dataset = '''${___USE_COMMA___}
+#set $___USE_COMMA___ = ","
+%(name)s = r2g2_input_%(placeholder)s''',
+    not_determined = '''
+                                                         #if str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s_type_selector ) != 'skip':
+                                                             ${___USE_COMMA___}
+                                                             #set $___USE_COMMA___ = ","\n
+                                                             #if str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s_type_selector ) == 'dataset':
+                                                                 %(name)s = r2g2_input_%(placeholder)s
+                                                             #elif str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s_type_selector ) == 'text':
+                                                                 %(name)s = "${ %(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s }"
+                                                             #elif str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s_type_selector ) == 'integer':
+                                                                 %(name)s = ${ %(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s }
+                                                             #elif str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s_type_selector ) == 'float':
+                                                                 %(name)s = ${ %(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s }
+                                                             #elif str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s_type_selector ) == 'boolean':
+                                                                 %(name)s = ${ %(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s }
+                                                             #elif str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s_type_selector ) == 'select':
+                                                                 #raise ValueError( 'not implemented' )
+                                                                 %(name)s = "${ %(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s }"
+                                                             #elif str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s_type_selector ) == 'NULL':
+                                                                 %(name)s = NULL
+                                                             #end if
+                                                         #end if
+                                                         ''',
+    quoted = '''${___USE_COMMA___}
+#set $___USE_COMMA___ = ","
+%(name)s = "${ %(prefix)s%(placeholder)s_type.%(placeholder)s }"''',
+    unquoted = '''${___USE_COMMA___}
+#set $___USE_COMMA___ = ","
+%(name)s = ${ %(prefix)s%(placeholder)s_type.%(placeholder)s }''',
+    )
+
+RSCRIPT_SLOTS_ARGUMENT = dict(
+    slots = '''
+#if str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type_selector ) != 'skip':
+${___USE_COMMA___}
+#set $___USE_COMMA___ = ","
+#if str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type_selector ) == 'slots':
+%(name)s = r2g2_slots
+#else
+%(name)s = ${ %(prefix)s%(placeholder)s_type.%(placeholder)s }L
+#end if
+#end if
+''',
+    bpparam = '''
+#if str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type_selector ) != 'skip':
+${___USE_COMMA___}
+#set $___USE_COMMA___ = ","
+#if str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type_selector ) == 'slots':
+%(name)s = r2g2_bpparam( r2g2_slots )
+#else
+%(name)s = r2g2_bpparam( ${ %(prefix)s%(placeholder)s_type.%(placeholder)s }L )
+#end if
+#end if
+''',
+    )
+
+RSCRIPT_ELLIPSIS = '''
+                                                #for $___eli_index___, $eli in enumerate( $%(prefix)s___ellipsis___ ):
+                                                    #if str( $eli.argument_type.argument_type_selector ) != 'skip':
+                                                         ${___USE_COMMA___}
+                                                         #set $___USE_COMMA___ = ","\n
+                                                         #if str( $eli.argument_type.argument_type_selector ) == 'dataset':
+                                                             ${eli.argument_name} = r2g2_input_ellipsis_${___eli_index___}
+                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'text':
+                                                             ${eli.argument_name} = "${eli.argument_type.argument}"
+                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'integer':
+                                                             ${eli.argument_name} = ${eli.argument_type.argument}
+                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'float':
+                                                             ${eli.argument_name} = ${eli.argument_type.argument}
+                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'boolean':
+                                                             ${eli.argument_name} = ${eli.argument_type.argument}
+                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'select':
+                                                             #raise ValueError( 'not implemented' )
+                                                             ${eli.argument_name} = "${eli.argument_type.argument}"
+                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'NULL':
+                                                             ${eli.argument_name} = NULL
+                                                         #end if
+                                                     #end if
+                                                #end for
+                                                '''
+
+# Rscript fragments binding each dataset argument before the call, as a promise read when the function first uses it (r2g2_bind_rds())
+RSCRIPT_BIND_ARGUMENT = dict(
+    dataset = '''
+r2g2_bind_rds( "r2g2_input_%(placeholder)s", %(name_string)s, "${%(prefix)sinput_%(placeholder)s}" )''',
+    not_determined = '''
+#if str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s_type_selector ) == 'dataset':
+r2g2_bind_rds( "r2g2_input_%(placeholder)s", %(name_string)s, "${%(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s}" )
+#end if''',
+    )
+
+RSCRIPT_BIND_ELLIPSIS = '''
+#for $___eli_index___, $eli in enumerate( $%(prefix)s___ellipsis___ ):
+#if str( $eli.argument_type.argument_type_selector ) == 'dataset':
+r2g2_bind_rds( "r2g2_input_ellipsis_${___eli_index___}", "${eli.argument_name}", "${eli.argument_type.argument}" )
+#end if
+#end for'''
+
+# With --release_inputs, the bindings are dropped once the call returns, so the inputs can be collected before the result is saved
+RSCRIPT_RELEASE_INPUTS = '''
+rm( list = ls( pattern = "^r2g2_input_" ) )
+invisible( gc() )'''
+
+# --compact_xml variants, calling the r2g2_argument() #def of @RSCRIPT_ARGUMENT_DEF@
+RSCRIPT_ARGUMENT_DEF = '''@RSCRIPT_ARGUMENT_DEF@
+'''
+
+RSCRIPT_COMPACT_NOT_DETERMINED = '''
+#if str( $%(prefix)s%(placeholder)s_type.%(placeholder)s_type.%(placeholder)s_type_selector ) != 'skip':
+${___USE_COMMA___}
+#set $___USE_COMMA___ = ","
+$r2g2_argument( %(name_literal)s, $%(prefix)s%(placeholder)s_type.%(placeholder)s_type, %(placeholder_literal)s, 'r2g2_input_%(placeholder)s' )
+#end if'''
+
+RSCRIPT_COMPACT_ELLIPSIS = '''
+#for $___eli_index___, $eli in enumerate( $%(prefix)s___ellipsis___ ):
+#if str( $eli.argument_type.argument_type_selector ) != 'skip':
+${___USE_COMMA___}
+#set $___USE_COMMA___ = ","
+$r2g2_argument( str( $eli.argument_name ), $eli.argument_type, 'argument', 'r2g2_input_ellipsis_' + str( $___eli_index___ ) )
 #end if
+#end for'''
+
+RSCRIPT_CALL_END = '''
+) )'''
+
+# Size in memory of the result; only computed with the output_metrics output, r2g2_metric() arguments being lazy
+RSCRIPT_RESULT_SIZE = '''
+r2g2_metric( "object_size", "rval", bytes = as.numeric( object.size( rval ) ) )'''
+
+RSCRIPT_FOOTER = SAVE_R_OBJECT_TEXT + '''@RSCRIPT_METRICS_END@
 '''
 
-def generate_LOAD_MATRIX_TOOL_XML():
+def generate_LOAD_MATRIX_TOOL_XML( package_info ):
     LOAD_MATRIX_TOOL_XML ='''<tool id="r_load_matrix" name="Load Tabular Data into R" version="%(galaxy_tool_version)s">
     <description>
         as a Matrix / Dataframe
@@ -263,13 +765,18 @@ def generate_LOAD_MATRIX_TOOL_XML():
         #if "output_r_script" in str( $include_outputs ).split( "," ):
             cp '${r_load_script}' '${output_r_script}' &&
         #end if
+        @GALAXY_SLOTS_ENV@
         Rscript '${r_load_script}'
     ]]>
     </command>
     <configfiles>
         <configfile name="r_load_script"><![CDATA[
+@RSCRIPT_METRICS_START@
 @RSCRIPT_LOAD_TABULAR_FILE@
-saveRDS(input_abundance, file = "${output_r_dataset}", ascii = FALSE, version = 2, compress = TRUE )
+@RSCRIPT_SAVE_RDS@
+r2g2_timed( "saveRDS", "input_abundance", r2g2_save_rds( input_abundance, "${output_r_dataset}" ) )
+r2g2_metric( "file_size", "output_r_dataset", bytes = file.size( "${output_r_dataset}" ) )
+@RSCRIPT_METRICS_END@
 
 
     ]]>
@@ -277,8 +784,10 @@ saveRDS(input_abundance, file = "${output_r_dataset}", ascii = FALSE, version =
     </configfiles>
     <inputs>
         <expand macro="params_load_tabular_file" />
+        <expand macro="params_rds_serialization" />
         <param name="include_outputs" type="select" multiple="True" label="Datasets to create">
             <option value="output_r_script" selected="false">R script</option>
+            <option value="output_metrics" selected="false">Run time and memory metrics</option>
         </param>
     </inputs>
     <outputs>
@@ -287,6 +796,9 @@ saveRDS(input_abundance, file = "${output_r_dataset}", ascii = FALSE, version =
         <data format="txt" name="output_r_script" label="${tool.name} on ${on_string} (Rscript)">
             <filter>"output_r_script" in include_outputs</filter>
         </data>
+        <data format="tabular" name="output_metrics" label="${tool.name} on ${on_string} (metrics)">
+            <filter>"output_metrics" in include_outputs</filter>
+        </data>
     </outputs>
     <tests>
         <test>
@@ -304,9 +816,249 @@ saveRDS(input_abundance, file = "${output_r_dataset}", ascii = FALSE, version =
     </help>
     <citations>
     </citations>
-</tool>''' % dict( package_name=package_name, package_version=package_version, r_name=r_name, galaxy_tool_version=galaxy_tool_version )
+</tool>''' % package_info
     return LOAD_MATRIX_TOOL_XML
 
+pipeline_tool_xml = '''<tool id="%(id)s" name="%(r_name)s pipeline" version="@VERSION@-%(galaxy_tool_version)s">
+    <description><![CDATA[chain %(r_name)s functions in a single R session]]></description>
+    <macros>
+        <import>%(r_name)s_macros.xml</import>
+    </macros>
+    <expand macro="requirements" />
+    <expand macro="stdio" />
+    <expand macro="version_command" />
+    <command><![CDATA[
+        #if "output_r_script" in str( $include_outputs ).split( "," ):
+            cp '${%(id_underscore)s_script}' '${output_r_script}' &&
+        #end if
+        mkdir -p r2g2_step_results &&
+        @GALAXY_SLOTS_ENV@
+        Rscript '${%(id_underscore)s_script}'
+    ]]>
+    </command>
+    <configfiles>
+         <configfile name="%(id_underscore)s_script"><![CDATA[#!/usr/bin/env RScript
+%(rscript_content)s
+    ]]>
+         </configfile>
+    </configfiles>
+    <inputs>
+        <repeat name="steps" title="Step" min="1">
+            <conditional name="step">
+                <param name="step_function" type="select" label="Function">
+%(function_options)s
+                </param>%(function_whens)s
+            </conditional>
+        </repeat>
+        <expand macro="params_rds_serialization" />
+        <param name="include_outputs" type="select" multiple="True" label="Datasets to create">
+            <option value="output_r_dataset" selected="true">Result of the last step in RDS format</option>
+            <option value="output_step_results" selected="false">Results of the steps marked to be saved, in RDS format</option>
+            <option value="output_r_script" selected="false">R script</option>
+            <option value="output_metrics" selected="false">Run time and memory metrics</option>
+        </param>
+    </inputs>
+    <outputs>
+        <data format="rds" name="output_r_dataset" label="${tool.name} on ${on_string} (RDS)">
+            <filter>"output_r_dataset" in include_outputs</filter>
+        </data>
+        <collection name="output_step_results" type="list" label="${tool.name} on ${on_string} (step results)">
+            <discover_datasets pattern="(?P&lt;designation&gt;.+)\\.rds" directory="r2g2_step_results" format="rds" />
+            <filter>"output_step_results" in include_outputs</filter>
+        </collection>
+        <data format="txt" name="output_r_script" label="${tool.name} on ${on_string} (Rscript)">
+            <filter>"output_r_script" in include_outputs</filter>
+        </data>
+        <data format="tabular" name="output_metrics" label="${tool.name} on ${on_string} (metrics)">
+            <filter>"output_metrics" in include_outputs</filter>
+        </data>
+    </outputs>
+    <help><![CDATA[
+Runs several %(r_name)s functions one after the other in a single R session.
+
+Each step calls one function, with the same inputs as the function's own tool, and can pass
+the result of the previous step as one of its arguments. Only the result of the last step,
+and of the steps marked to be saved, are written to RDS datasets.
+    ]]></help>
+<tests>
+    <test>
+    </test>
+</tests>
+<citations>
+</citations>
+</tool>
+<!-- Created automatically using R2-G2: https://github.com/blankenberg/r2g2 -->
+'''
+
+PIPELINE_FUNCTION_OPTION = '''                    <option value=%(value)s>%(label)s</option>'''
+
+PIPELINE_FUNCTION_WHEN = '''
+                <when value=%(value)s>
+                    <param name="pass_previous" type="select" label="Pass the result of the previous step as" help="Ignored in the first step">
+                        %(pass_previous)s
+                    </param>
+                    %(inputs)s
+                    <param name="save_result" type="boolean" truevalue="True" falsevalue="False" checked="False" label="Save the result of this step"/>
+                </when>'''
+
+# Rscript fragments of the pipeline tool, one step block per function
+PIPELINE_RSCRIPT_HEADER = CONFIG_SPLIT_DESIRED_OUTPUTS + '''
+@RSCRIPT_METRICS_START@
+@RSCRIPT_INPUTS@
+@RSCRIPT_GALAXY_SLOTS@
+r2g2_timed( "library", "%(r_name)s", library(%(r_name)s) )
+@RSCRIPT_SAVE_RDS@
+#for $___step_index___, $___step___ in enumerate( $steps ):'''
+
+PIPELINE_STEP_START = '''
+#%(keyword)s str( $___step___.step.step_function ) == %(rname_literal)s:'''
+
+PIPELINE_CALL_START = '''
+#set $___USE_COMMA___ = ""
+rval <- r2g2_timed( "call", sprintf( "step %%i: %%s", ${___step_index___} + 1L, %(rname_string)s ), %(rname)s(
+#if $___step_index___ > 0 and str( $___step___.step.pass_previous ) != "___none___":
+#set $___USE_COMMA___ = ","
+${___step___.step.pass_previous} = rval
+#end if'''
+
+PIPELINE_ARGUMENT_START = '''
+#if $___step_index___ == 0 or str( $___step___.step.pass_previous ) != %(name_literal)s:'''
+
+PIPELINE_STEP_END = '''
+r2g2_metric( "object_size", sprintf( "step %%i: %%s", ${___step_index___} + 1L, %(rname_string)s ), bytes = as.numeric( object.size( rval ) ) )
+#if str( $___step___.step.save_result ) == "True":
+r2g2_timed( "saveRDS", sprintf( "step %%i: %%s", ${___step_index___} + 1L, %(rname_string)s ), r2g2_save_rds( rval, file.path( "r2g2_step_results", sprintf( "step_%%03i_%%s.rds", ${___step_index___} + 1L, %(rname_string)s ) ) ) )
+#end if'''
+
+PIPELINE_RSCRIPT_FOOTER = '''
+#end if
+#end for
+#if "output_r_dataset" in $include_files:
+r2g2_timed( "saveRDS", "rval", r2g2_save_rds( rval, "${output_r_dataset}" ) )
+r2g2_metric( "file_size", "output_r_dataset", bytes = file.size( "${output_r_dataset}" ) )
+#end if
+@RSCRIPT_METRICS_END@
+'''
+
+collection_tool_xml = '''<tool id="%(id)s" name="%(name)s" version="@VERSION@-%(galaxy_tool_version)s">
+    <description><![CDATA[%(description)s]]></description>
+    <macros>
+        <import>%(r_name)s_macros.xml</import>
+    </macros>
+    <expand macro="requirements" />
+    <expand macro="stdio" />
+    <expand macro="version_command" />
+    <command><![CDATA[
+        #if "output_r_script" in str( $include_outputs ).split( "," ):
+            cp '${%(id_underscore)s_script}' '${output_r_script}' &&
+        #end if
+        mkdir -p r2g2_collection_results &&
+        @GALAXY_SLOTS_ENV@
+        Rscript '${%(id_underscore)s_script}'
+    ]]>
+    </command>
+    <configfiles>
+         <configfile name="%(id_underscore)s_elements"><![CDATA[#for $___element___ in $%(collection_placeholder)s:
+${___element___.element_identifier}	${___element___}
+#end for
+]]>
+         </configfile>
+         <configfile name="%(id_underscore)s_script"><![CDATA[#!/usr/bin/env RScript
+%(rscript_content)s
+    ]]>
+         </configfile>
+    </configfiles>
+    <inputs>
+        <param name="%(collection_placeholder)s" type="data_collection" collection_type="list" format="rds" label=%(collection_label)s help=%(collection_help)s/>
+%(inputs)s
+        <expand macro="params_rds_serialization" />
+        <param name="include_outputs" type="select" multiple="True" label="Datasets to create">
+            <option value="output_r_script" selected="false">R script</option>
+            <option value="output_metrics" selected="false">Run time and memory metrics</option>
+        </param>
+    </inputs>
+    <outputs>
+        <collection name="output_collection" type="list" label="${tool.name} on ${on_string} (RDS)">
+            <discover_datasets pattern="[0-9]+_(?P&lt;designation&gt;.+)\\.rds" directory="r2g2_collection_results" format="rds" sort_by="filename" />
+        </collection>
+        <data format="tabular" name="output_errors" label="${tool.name} on ${on_string} (errors)"/>
+        <data format="txt" name="output_r_script" label="${tool.name} on ${on_string} (Rscript)">
+            <filter>"output_r_script" in include_outputs</filter>
+        </data>
+        <data format="tabular" name="output_metrics" label="${tool.name} on ${on_string} (metrics)">
+            <filter>"output_metrics" in include_outputs</filter>
+        </data>
+    </outputs>
+    <help><![CDATA[
+Runs %(rname)s on each element of a collection, in a single R session.
+
+Elements on which the function fails are listed with the error in the errors dataset
+and left out of the output collection; the job only fails when every element does.
+
+Automatically Parsed R Help
+===========================
+
+%(help_rst)s
+    ]]></help>
+<tests>
+    <test>
+    </test>
+</tests>
+<citations>
+</citations>
+</tool>
+<!-- Created automatically using R2-G2: https://github.com/blankenberg/r2g2 -->
+'''
+
+# Rscript fragments of the collection variant of a function tool, calling it once per element
+COLLECTION_RSCRIPT_HEADER = CONFIG_SPLIT_DESIRED_OUTPUTS + '''
+@RSCRIPT_METRICS_START@
+@RSCRIPT_INPUTS@
+@RSCRIPT_GALAXY_SLOTS@
+r2g2_timed( "library", "%(r_name)s", library(%(r_name)s) )
+@RSCRIPT_SAVE_RDS@
+r2g2_elements <- read.delim( "${%(id_underscore)s_elements}", header = FALSE, sep = "\\t", quote = "", comment.char = "",
+                             colClasses = "character", col.names = c( "identifier", "path" ) )
+r2g2_errors <- data.frame( element = character( 0 ), error = character( 0 ), stringsAsFactors = FALSE )'''
+
+# The other dataset arguments are bound before the loop, so they are read at most once for all the elements
+COLLECTION_CALL_START = '''
+for ( r2g2_element in seq_len( nrow( r2g2_elements ) ) ) {
+r2g2_identifier <- r2g2_elements[[ "identifier" ]][[ r2g2_element ]]
+r2g2_bind_rds( "r2g2_input_%(placeholder)s", r2g2_identifier, r2g2_elements[[ "path" ]][[ r2g2_element ]] )
+r2g2_failed <- FALSE
+rval <- tryCatch( r2g2_timed( "call", r2g2_identifier, %(rname)s(
+%(name)s = r2g2_input_%(placeholder)s
+#set $___USE_COMMA___ = ","
+'''
+
+COLLECTION_CALL_END = '''
+) ), error = function( e ) {
+    r2g2_failed <<- TRUE
+    gsub( "[\\t\\n]", " ", conditionMessage( e ) )
+} )'''
+
+COLLECTION_RELEASE_INPUT = '''
+rm( r2g2_input_%(placeholder)s )
+invisible( gc() )'''
+
+COLLECTION_RSCRIPT_FOOTER = '''
+if ( r2g2_failed ) {
+    message( "Failed on ", r2g2_identifier, ": ", rval )
+    r2g2_errors[ nrow( r2g2_errors ) + 1L, ] <- list( r2g2_identifier, rval )
+} else {
+    r2g2_metric( "object_size", r2g2_identifier, bytes = as.numeric( object.size( rval ) ) )
+    r2g2_timed( "saveRDS", r2g2_identifier, r2g2_save_rds( rval, file.path( "r2g2_collection_results", sprintf( "%06i_%s.rds", r2g2_element, gsub( "/", "_", r2g2_identifier, fixed = TRUE ) ) ) ) )
+}
+rm( rval )
+}
+write.table( r2g2_errors, file = "${output_errors}", sep = "\\t", quote = FALSE, row.names = FALSE )
+@RSCRIPT_METRICS_END@
+if ( nrow( r2g2_errors ) > 0L && nrow( r2g2_errors ) == nrow( r2g2_elements ) ) {
+    stop( "the function failed on every element of the collection" )
+}
+'''
+
 SAFE_CHARS = list( x for x in string.ascii_letters + string.digits + '_' )
 def simplify_text( text ):
     return ''.join( [ x if x in SAFE_CHARS else '_' for x in text ] )
@@ -368,323 +1120,1685 @@ def unroll_vector_to_text( section ):
 
 
 
-robjects.r('''
+R_LOAD_RD_DB = '''
+function( pkg ) {
+    db <- tools::Rd_db( pkg )
+    list( db = db,
+          aliases = lapply( db, function( rd ) tools:::.Rd_get_metadata( rd, "alias" ) ),
+          texts = vapply( db, function( rd ) paste( as.character( rd ), collapse = "" ), "" ) )
+}
+'''
 
-    ctr <- 0
-    dlBrowser <- function( url ) {
-    print( paste( "Fetching", url) )
-    #Sys.sleep(5)
-    download.file( url, destfile = paste0( "./html/",ctr,".html"), method="wget" )
-    ctr <- ctr + 1
-    ctr
-        }
-options( browser= dlBrowser)
-''')
 
+R_INVENTORY_PACKAGE = '''
+function( pkg ) {
+    ns <- asNamespace( pkg )
+    names <- sort( getNamespaceExports( ns ), method = "radix" )
+    kinds <- vapply( names, function( name ) {
+        obj <- get0( name, envir = ns )
+        if ( is.primitive( obj ) ) "primitive" else if ( is.function( obj ) ) "function" else class( obj )[ 1 ]
+    }, "", USE.NAMES = FALSE )
+    list( names = names, kinds = kinds )
+}
+'''
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--name", help="Package Name", required="True" )
-parser.add_argument("--package_name", help="[Conda] Package Name", default=None)
-parser.add_argument("--package_version", help="[Conda] Package Version", default=None)
-parser.add_argument("--out", help="Output directory", default='out')
-parser.add_argument("--create_load_matrix_tool", help="Output a tool that will create an RDS from a tabular matrix", action='store_true')
-parser.add_argument("--galaxy_tool_version", help="Additional Galaxy Tool Version", default='0.0.1')
 
-args = parser.parse_args()
+R_INTROSPECT_PACKAGE = '''
+function( pkg, fn_names = NULL ) {
+    ns <- asNamespace( pkg )
+    if ( is.null( fn_names ) ) fn_names <- sort( getNamespaceExports( ns ), method = "radix" )
+    fn_names <- fn_names[ vapply( fn_names, function( name ) is.function( get0( name, envir = ns ) ), NA ) ]
+    fmls <- lapply( fn_names, function( name ) {
+        f <- get( name, envir = ns )
+        as.list( if ( is.primitive( f ) ) formals( args( f ) ) else formals( f ) )
+    } )
+    values <- unlist( unname( fmls ), recursive = FALSE )
+    if ( is.null( values ) ) values <- list()
+    # values may hold the empty symbol of formals without default, so only ever touch them as values[[ i ]]
+    idx <- seq_along( values )
+    atomic <- vapply( idx, function( i ) is.atomic( values[[ i ]] ) && length( values[[ i ]] ) > 0, NA )
+    firsts <- lapply( idx, function( i ) if ( atomic[ i ] ) values[[ i ]][ 1 ] else NULL )
+    list( version = as.character( packageVersion( pkg ) ),
+          names = fn_names,
+          counts = vapply( fmls, length, 0L ),
+          formal_names = as.character( unlist( lapply( fmls, names ), use.names = FALSE ) ),
+          types = vapply( idx, function( i ) typeof( values[[ i ]] ), "" ),
+          lengths = vapply( idx, function( i ) length( values[[ i ]] ), 0L ),
+          nas = vapply( idx, function( i ) atomic[ i ] && is.na( firsts[[ i ]] ) && !( is.double( firsts[[ i ]] ) && is.nan( firsts[[ i ]] ) ), NA ),
+          firsts = firsts,
+          deparsed = vapply( idx, function( i ) paste( deparse( values[[ i ]] ), collapse = " " ), "" ),
+          shown = vapply( idx, function( i ) paste( capture.output( print( values[ i ] ) ), collapse = "\\n" ), "" ) )
+}
+'''
 
-r_name = args.name
-package_name = args.package_name or r_name
-#utils = rpackages.importr("utils")
-package_importr = rpackages.importr(r_name)
+# R typeof() names to the SEXP type names used when classifying inputs
+R_TYPEOF_TO_SEXP = { 'NULL': 'NILSXP', 'symbol': 'SYMSXP', 'pairlist': 'LISTSXP', 'closure': 'CLOSXP',
+                     'environment': 'ENVSXP', 'language': 'LANGSXP', 'special': 'SPECIALSXP',
+                     'builtin': 'BUILTINSXP', 'char': 'CHARSXP', 'logical': 'LGLSXP', 'integer': 'INTSXP',
+                     'double': 'REALSXP', 'complex': 'CPLXSXP', 'character': 'STRSXP', '...': 'DOTSXP',
+                     'any': 'ANYSXP', 'expression': 'EXPRSXP', 'list': 'VECSXP', 'externalptr': 'EXTPTRSXP',
+                     'bytecode': 'BCODESXP', 'weakref': 'WEAKREFSXP', 'raw': 'RAWSXP', 'S4': 'S4SXP' }
 
-package_version = args.package_version or package_importr.__version__
 
-galaxy_tool_version = args.galaxy_tool_version
+def format_first_value( r_type, value, is_na ):
+    """Format the first element of an atomic default value the way str() does on the rpy2 element."""
+    if is_na:
+        return 'NA'
+    if r_type == 'LGLSXP':
+        return str( bool( value ) )
+    if r_type == 'REALSXP':
+        return str( float( value ) )
+    if r_type == 'INTSXP':
+        return str( int( value ) )
+    return str( value )
 
-package_dict = {}
-skipped = 0
-try:
-    os.makedirs( args.out )
-except os.error:
-    pass
 
+def get_first_value( formal ):
+    if formal['value'] is None:
+        raise IndexError( "%s has an empty default value" % ( formal['name'] ) )
+    return formal['value']
 
-with open( os.path.join( args.out, "%s_macros.xml" % ( r_name ) ), 'w+' ) as out:
-    out.write( generate_macro_xml() )
 
-if args.create_load_matrix_tool:
-    with open( os.path.join( args.out, "r_load_matrix.xml" ), 'w+' ) as out:
-        out.write( generate_LOAD_MATRIX_TOOL_XML() )
+def inventory_package( r_name ):
+    """Every export of the package and its kind ('function', 'primitive' or the class of other objects), in one R call.
 
-for j, name in enumerate( dir( package_importr ) ):
-    print('Starting',j,name)
-    try:
-        package_obj = getattr( package_importr, name )
-        rname = package_obj.__rname__
-        #print "package_obj name", name, package_obj, type( package_obj ), package_obj.typeof, str_typeint( package_obj.typeof )
-        print('rname', rname)
-        if '.' in rname and False:
-            print("Skipping:", rname)
-            skipped+=1
-            continue
-        xml_dict = {
-                    'package_name': package_name,
-                    'id': "%s_%s" % ( package_name, rname ),
-                    'galaxy_tool_version': galaxy_tool_version,
-                    'name': "%s" % ( rname ),
-                    'description': '',
-                    'inputs': '',
-                    'rscript_content': '',
-                    'outputs': '',
-                    'help_rst': '',
-                    'r_name': r_name,
-                    }
-        xml_dict['id_underscore'] = simplify_text( xml_dict['id'] )
-        xml_dict['id'] = simplify_text( xml_dict['id'] ) # ToolShed doesn't like e.g. '-'' in ids
-        
+    Returns a list of ( name, kind ) sorted by name, in the C locale's order whatever R's locale."""
+    res = get_robjects().r( R_INVENTORY_PACKAGE )( r_name )
+    return list( zip( res.rx2( 'names' ), res.rx2( 'kinds' ) ) )
 
-        help = pages( rname )
+
+def print_inventory( r_name, inventory, function_filter ):
+    """Print the ( name, kind ) of inventory_package() as --inventory rows, with whether function_filter selects them."""
+    for name, kind in inventory:
+        print('%s\t%s\t%s\t%s' % ( r_name, name, kind, 'selected' if kind in ( 'function', 'primitive' ) and function_filter( name ) else '' ))
+
+
+def introspect_package( r_name, rnames=None ):
+    """Introspect every exported function of the package, or only rnames, in a single R call, without an importr() wrapper.
+
+    Returns ( package version, functions ), each function being a dict of its rname and a list of formals;
+    a formal is a dict of name, SEXP type, length, formatted first value, deparsed and printed default."""
+    robjects = get_robjects()
+    if rnames is None:
+        res = robjects.r( R_INTROSPECT_PACKAGE )( r_name )
+    else:
+        res = robjects.r( R_INTROSPECT_PACKAGE )( r_name, robjects.StrVector( rnames ) )
+    columns = dict( ( key, list( res.rx2( key ) ) ) for key in ( 'formal_names', 'types', 'lengths', 'nas', 'deparsed', 'shown' ) )
+    formals = []
+    for i, first in enumerate( res.rx2( 'firsts' ) ):
+        r_type = R_TYPEOF_TO_SEXP.get( columns['types'][i], columns['types'][i].upper() )
+        value = None
+        if len( first ):
+            value = format_first_value( r_type, first[0], bool( columns['nas'][i] ) )
+        formals.append( dict( name=columns['formal_names'][i],
+                              type=r_type,
+                              length=int( columns['lengths'][i] ),
+                              value=value,
+                              deparsed=columns['deparsed'][i],
+                              shown=columns['shown'][i] ) )
+    functions = []
+    offset = 0
+    for rname, count in zip( res.rx2( 'names' ), res.rx2( 'counts' ) ):
+        functions.append( dict( rname=rname, formals=formals[offset:offset + count] ) )
+        offset += count
+    return res.rx2( 'version' )[0], functions
+
+
+def parse_shard( value ):
+    """Parse --shard K/N into ( K, N ), with 1 <= K <= N."""
+    try:
+        shard, shards = [ int( x ) for x in value.split( '/' ) ]
+    except ValueError:
+        raise argparse.ArgumentTypeError( "expected K/N, e.g. 1/4: %s" % ( value ) )
+    if not 1 <= shard <= shards:
+        raise argparse.ArgumentTypeError( "K must be between 1 and N: %s" % ( value ) )
+    return shard, shards
+
+
+def get_shard( rname, shards ):
+    """Shard, from 1 to shards, of a function: a hash of its name, the same on every host and Python (unlike hash())."""
+    return int( hashlib.sha1( rname.encode( 'utf-8' ) ).hexdigest(), 16 ) % shards + 1
+
+
+class FunctionFilter( object ):
+    """Selects functions by name: --include patterns or --functions_from names, minus --exclude patterns.
+
+    Patterns are fnmatch style, e.g. 'plot*'; with neither includes nor names every function is included.
+    With a shard ( K, N ), only the functions of shard K of N are selected, see get_shard()."""
+
+    def __init__( self, includes=None, excludes=None, names=None, shard=None ):
+        self.includes = includes or []
+        self.excludes = excludes or []
+        self.names = set( names or [] )
+        self.shard = shard
+
+    @property
+    def active( self ):
+        return bool( self.includes or self.excludes or self.names or self.shard )
+
+    def __call__( self, rname ):
+        if self.shard and get_shard( rname, self.shard[1] ) != self.shard[0]:
+            return False
+        if self.includes or self.names:
+            if rname not in self.names and not any( fnmatch.fnmatchcase( rname, pattern ) for pattern in self.includes ):
+                return False
+        return not any( fnmatch.fnmatchcase( rname, pattern ) for pattern in self.excludes )
+
+
+def read_functions_file( path ):
+    """Function names listed one per line, ignoring blank lines and # comments."""
+    with open( path ) as fh:
+        return [ line.strip() for line in fh if line.strip() and not line.strip().startswith( '#' ) ]
+
+
+def introspect_selected_functions( r_name, function_filter ):
+    """introspect_package() for the functions selected by function_filter only.
+
+    An inventory of the exports picks the names first, so functions that are not selected are never introspected."""
+    if not function_filter.active:
+        return introspect_package( r_name )
+    inventory = inventory_package( r_name )
+    rnames = [ name for name, kind in inventory if kind in ( 'function', 'primitive' ) and function_filter( name ) ]
+    exported = set( name for name, kind in inventory )
+    for name in sorted( function_filter.names - exported ):
+        print('Not exported by %s: %s' % ( r_name, name ))
+    return introspect_package( r_name, rnames )
+
+
+def get_signature_rst( function_info ):
+    """Help text for functions without a help page: their signature as a literal block."""
+    arguments = []
+    for formal in function_info['formals']:
+        if formal['deparsed']:
+            arguments.append( '%s = %s' % ( formal['name'], formal['deparsed'] ) )
+        else:
+            arguments.append( formal['name'] )
+    return '::\n\n  %s(%s)' % ( function_info['rname'], ', '.join( arguments ) )
+
+
+class PackageHelp( object ):
+    """The help pages of one package, loaded once from its Rd database.
+
+    The last cache_size rendered Rd files are kept, so aliases sharing a page (e.g. foo, foo.default, print.foo)
+    usually reuse it without the rendered help of the whole package staying in memory."""
+
+    def __init__( self, r_name, cache_size=128 ):
+        rd_db = get_robjects().r( R_LOAD_RD_DB )( r_name )
+        self._db = rd_db.rx2( 'db' )
+        self._rd_files = {}
+        aliases = rd_db.rx2( 'aliases' )
+        for rd_file, rd_aliases in zip( aliases.names, aliases ):
+            for alias in rd_aliases:
+                self._rd_files.setdefault( alias, rd_file )
+        self._hashes = {}
+        for rd_file, text in zip( rd_db.rx2( 'texts' ).names, rd_db.rx2( 'texts' ) ):
+            self._hashes[rd_file] = hashlib.sha256( text.encode( 'utf-8' ) ).hexdigest()
+        self._rendered = collections.OrderedDict()
+        self._cache_size = cache_size
+
+    def get_rd_file( self, rname ):
+        return self._rd_files.get( rname )
+
+    def get_hash( self, rname ):
+        """Hash of the Rd source of the page documenting rname, '' if there is none."""
+        return self._hashes.get( self._rd_files.get( rname ), '' )
+
+    def get_help( self, rname ):
+        """Returns ( help_rst, title ) for rname; raises KeyError if the package does not document it."""
+        from rpy2.robjects.help import Page
+        rd_file = self._rd_files[rname]
+        if rd_file in self._rendered:
+            self._rendered.move_to_end( rd_file )
+        else:
+            help_page = Page( self._db.rx2( rd_file ) )
+            description = ''
+            if 'title' in list(help_page.sections.keys()):
+                description = unroll_vector_to_text( help_page.sections[ 'title' ] )
+            self._rendered[rd_file] = ( to_docstring( help_page ), description )
+            if len( self._rendered ) > self._cache_size:
+                self._rendered.popitem( last=False )
+        return self._rendered[rd_file]
+
+
+class SnapshotHelp( object ):
+    """The help of one package as stored in a snapshot by --extract; same interface as PackageHelp, without R."""
+
+    def __init__( self, package_snapshot ):
+        self._rd_files = dict( ( function_info['rname'], function_info['rd'] ) for function_info in package_snapshot['functions'] )
+        self._help = package_snapshot['help']
+
+    def get_rd_file( self, rname ):
+        return self._rd_files.get( rname )
+
+    def get_hash( self, rname ):
+        return self._help.get( self._rd_files.get( rname ), {} ).get( 'hash', '' )
+
+    def get_help( self, rname ):
+        entry = self._help[self._rd_files[rname]]
+        if entry['rst'] is None:
+            raise KeyError( "%s could not be rendered when extracted" % ( rname ) )
+        return entry['rst'], entry['title']
+
+
+SNAPSHOT_FORMAT = 1
+# Formals are stored as lists in this order to keep snapshots compact
+SNAPSHOT_FORMAL_FIELDS = ( 'name', 'type', 'length', 'value', 'deparsed', 'shown' )
+
+
+def extract_package( r_name, function_filter=None ):
+    """Everything the generator needs from R about one package, or its functions selected by function_filter, as a JSON serializable dict.
+
+    Help is rendered once per Rd file and shared by the functions it documents."""
+    version, functions = introspect_selected_functions( r_name, function_filter or FunctionFilter() )
+    help = extract_help( PackageHelp( r_name ), functions, {} )
+    return dict( r_name=r_name, version=version, functions=functions, help=help )
+
+
+def extract_help( package_help, functions, help ):
+    """Render the help of functions into help, a dict by Rd file, once per Rd file; sets the 'rd' of each function. Returns help."""
+    for function_info in functions:
+        rname = function_info['rname']
+        rd_file = package_help.get_rd_file( rname )
+        function_info['rd'] = rd_file
+        if rd_file is None or rd_file in help:
+            continue
         try:
-            join_char = ""
-            for i, help_page in enumerate( help ):
-                xml_dict['help_rst'] = join_char.join( [ xml_dict['help_rst'], to_docstring( help_page ) ] )
-                join_char = "\n\n"
-                if 'title' in list(help_page.sections.keys()) and not xml_dict['description']:
-                    xml_dict['description'] = unroll_vector_to_text( help_page.sections[ 'title' ] )#" ".join( map( str, help_page.sections[ 'title' ] ) )
-            if i > 1:
-                print(rname, "had multiple pages:", i, tuple( help ))
+            rst, title = package_help.get_help( rname )
         except Exception as e:
-            print("Falling back to docstring:", rname, e)
-            xml_dict['help_rst'] = package_obj.__doc__
-
-        inputs = []
-        input_names = []
-        input_file_name = None
-        for i, (formal_name, formal_value ) in enumerate( package_obj.formals().items() ):
-            #print 'formal_name', formal_name, type(formal_name)
-            #print 'formal_value', type(formal_value), formal_value
-            #print 'formal_value typeof, typeof_str', formal_value.typeof, str_typeint( formal_value.typeof )
-            default_value = ''
-            input_type = 'text'
-            input_dict = INPUT_NOT_DETERMINED_DICT.copy()
-            input_dict.update( {
-                          'name': simplify_text( formal_name ),
-                           'label': quoteattr( formal_name ),
-                           'help':quoteattr( str( formal_value ).strip() ),
-                           'value': '',
-                           'multiple': False,
-                          } )
-            input_template = optional_input_text
-            use_quotes = True
+            print("Could not render help:", rname, e)
+            rst, title = None, None
+        help[rd_file] = dict( rst=rst, title=title, hash=package_help.get_hash( rname ) )
+    return help
+
+
+def open_snapshot( path, mode ):
+    if path.endswith( '.gz' ):
+        return gzip.open( path, mode + 't', encoding='utf-8' )
+    return open( path, mode )
+
+
+def write_snapshot( path, packages ):
+    """Write extracted packages to path, gzip compressed if it ends with .gz."""
+    packages = [ dict( package, functions=[ dict( function_info, formals=[ [ formal[field] for field in SNAPSHOT_FORMAL_FIELDS ] for formal in function_info['formals'] ] )
+                                            for function_info in package['functions'] ] )
+                 for package in packages ]
+    with open_snapshot( path, 'w' ) as out:
+        json.dump( dict( format=SNAPSHOT_FORMAT, packages=packages ), out, separators=( ',', ':' ) )
+
+
+_snapshots = {}
+
+
+def load_snapshot( path ):
+    """Read a snapshot written by write_snapshot(); returns a dict of packages by r_name. Cached per process."""
+    if path not in _snapshots:
+        with open_snapshot( path, 'r' ) as fh:
+            snapshot = json.load( fh )
+        if snapshot.get( 'format' ) != SNAPSHOT_FORMAT:
+            raise ValueError( "%s is not a snapshot in format %s" % ( path, SNAPSHOT_FORMAT ) )
+        packages = {}
+        for package in snapshot['packages']:
+            for function_info in package['functions']:
+                function_info['formals'] = [ dict( zip( SNAPSHOT_FORMAL_FIELDS, formal ) ) for formal in function_info['formals'] ]
+            packages[package['r_name']] = package
+        _snapshots[path] = packages
+    return _snapshots[path]
+
+
+R_UNLOAD_PACKAGE = '''
+function( pkg ) {
+    # The next asNamespace() loads the package again from the library, e.g. after it was reinstalled
+    if ( pkg %in% loadedNamespaces() ) try( unloadNamespace( pkg ), silent = TRUE )
+    !( pkg %in% loadedNamespaces() )
+}
+'''
+
+
+class GeneratorServer( object ):
+    """What --serve keeps in memory between runs: the functions and help of each package it was asked for.
+
+    A package is introspected whole on first use and its help pages are rendered as they are needed,
+    so a run selecting other functions of it later does not go back to R for them."""
+
+    def __init__( self ):
+        self.packages = {}
+
+    def extract( self, r_name, function_filter ):
+        """extract_package() from memory."""
+        if r_name not in self.packages:
+            version, functions = introspect_package( r_name )
+            self.packages[r_name] = dict( version=version, functions=functions, package_help=PackageHelp( r_name ), help={} )
+        package = self.packages[r_name]
+        functions = [ function_info for function_info in package['functions'] if function_filter( function_info['rname'] ) ]
+        extract_help( package['package_help'], functions, package['help'] )
+        help = dict( ( function_info['rd'], package['help'][function_info['rd']] ) for function_info in functions if function_info['rd'] is not None )
+        return dict( r_name=r_name, version=package['version'], functions=functions, help=help )
+
+    def inventory( self, r_name ):
+        """inventory_package() from the warm R session; the client selects the functions."""
+        return inventory_package( r_name )
+
+    def invalidate( self, r_names ):
+        """Forget r_names, every package when empty, and unload their namespaces from R; returns the names forgotten."""
+        r_names = r_names or sorted( self.packages )
+        for r_name in r_names:
+            self.packages.pop( r_name, None )
+            if not get_robjects().r( R_UNLOAD_PACKAGE )( r_name )[0]:
+                print("Could not unload %s, another loaded package imports it; restart the server to load it again" % ( r_name ))
+        return r_names
+
+    def handle( self, request ):
+        if not isinstance( request, dict ) or 'command' not in request or not isinstance( request.get( 'r_names' ), list ):
+            raise ValueError( "malformed request, expected a dict with a command and a list of r_names" )
+        if request['command'] == 'extract':
+            function_filter = FunctionFilter( **request.get( 'function_filter' ) or {} )
+            return dict( packages=[ self.extract( r_name, function_filter ) for r_name in request['r_names'] ] )
+        if request['command'] == 'inventory':
+            return dict( inventories=[ self.inventory( r_name ) for r_name in request['r_names'] ] )
+        if request['command'] == 'invalidate':
+            return dict( invalidated=self.invalidate( request['r_names'] ) )
+        raise ValueError( "unknown command: %s" % ( request['command'] ) )
+
+
+def serve( address, r_names ):
+    """Answer the requests of --server runs on the Unix socket address, one at a time, until interrupted.
+
+    R stays up between requests. r_names are extracted before the first request."""
+    server = GeneratorServer()
+    get_robjects()
+    for r_name in r_names:
+        server.extract( r_name, FunctionFilter() )
+    if os.path.exists( address ):
+        try:
+            multiprocessing.connection.Client( address, family='AF_UNIX' ).close()
+        except ConnectionRefusedError:
+            os.unlink( address ) # left behind by a server that was killed
+        else:
+            raise ValueError( "a server is already running on %s" % ( address ) )
+    umask = os.umask( 0o077 ) # only this user can connect
+    try:
+        listener = multiprocessing.connection.Listener( address, family='AF_UNIX' )
+    finally:
+        os.umask( umask )
+    print('Serving on', address)
+    try:
+        while True:
             try:
-                value_name, value_value = list( formal_value.items() )[0]
-                #print 'value_name', value_name, type(value_name)
-                #print 'value_value typeof, typeof_str', value_value.typeof, str_typeint( value_value.typeof ), type(str_typeint( value_value.typeof ))  #use value_value
-                
-                r_type = str_typeint( value_value.typeof )
-                if r_type == 'INTSXP':
-                    input_type = 'integer'
-                    default_value = str( value_value[0] )
-                    input_template = optional_input_integer
-                    use_quotes = False
-                    input_dict[ 'integer_selected' ] = True
-                    input_type = 'not_determined'
-                elif r_type == 'LGLSXP': #this seems to have caught NA...FIXME
-                    input_type = 'boolean'
-                    default_value = str( value_value[0] )
-                    input_template = optional_input_boolean
-                    use_quotes = False
-                    if default_value == 'NULL':
-                        input_dict[ 'NULL_selected' ] = True
-                    elif default_value == 'NA':
-                        input_dict[ 'NA_selected' ] = True
-                    else:
-                        input_dict[ 'boolean_selected' ] = True
-                    input_type = 'not_determined'
-                elif r_type == 'REALSXP':
-                    input_type = 'float'
-                    default_value = str( value_value[0] )
-                    input_template = optional_input_float
-                    use_quotes = False
-                    input_dict[ 'float_selected' ] = True
-                    input_type = 'not_determined'
-                elif r_type == 'STRSXP':
-                    input_type = 'text'
-                    default_value = str( value_value[0] )
-                    input_template = optional_input_text
-                    input_dict[ 'text_selected' ] = True
-                    input_type = 'not_determined'
-                else:
-                    input_type = 'not_determined'
-                    input_template = optional_input_not_determined
-                    input_dict[ 'dataset_selected' ] = True
-                
-                length = len( list( value_value ) )
-                input_dict['multiple'] = ( length > 1 )
+                conn = listener.accept()
+                request = conn.recv()
+            except ( EOFError, OSError ):
+                continue
+            start = time.perf_counter()
+            # A malformed request is answered with an error like any other, it does not stop the server
+            description = 'malformed request'
+            try:
+                if isinstance( request, dict ):
+                    description = '%s %s' % ( request.get( 'command' ), ' '.join( map( str, request.get( 'r_names' ) or [] ) ) )
+                reply = server.handle( request )
             except Exception as e:
-                print('Error getting input param info:')
-                print(e)
-            
-            
-            
-            if input_type == 'dataset':
-                input_template = optional_input_dataset
-            elif input_type == 'boolean':
-                default_value = str( ( default_value.strip().lower() == 'true' ) )
-            
-            input_dict['value'] = quoteattr( default_value )
-            input_place_name = input_dict['name']
-            
-            
-            #FIXME: change ... into repeat with conditional to allow providing any? type of input, with/without names?
-            if formal_name in ['...']:
-                print('has ... need to replace with a repeat and conditional')
-                inputs.append( ellipsis_input % input_dict )
-                input_names.append( ( '...', '___ellipsis___', 'ellipsis', False ) )
+                reply = dict( error=str( e ) )
+            print('%s: %.3fs%s' % ( description, time.perf_counter() - start, ' (%s)' % ( reply['error'] ) if 'error' in reply else '' ))
+            try:
+                conn.send( reply )
+            except OSError:
+                pass
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+
+
+def request_server( address, request ):
+    """Send a request to the --serve server on the Unix socket address and return its reply; raises ValueError with its error."""
+    with multiprocessing.connection.Client( address, family='AF_UNIX' ) as conn:
+        conn.send( request )
+        reply = conn.recv()
+    if 'error' in reply:
+        raise ValueError( reply['error'] )
+    return reply
+
+
+R_SETUP = '''
+
+    ctr <- 0
+    dlBrowser <- function( url ) {
+    print( paste( "Fetching", url) )
+    #Sys.sleep(5)
+    download.file( url, destfile = paste0( "./html/",ctr,".html"), method="wget" )
+    ctr <- ctr + 1
+    ctr
+        }
+options( browser= dlBrowser)
+'''
+_r_setup_done = False
+
+
+def get_robjects():
+    """Import rpy2.robjects, which starts the embedded R, and set up R on first use.
+
+    rpy2 is only imported here, so rendering from a snapshot works without R."""
+    global _r_setup_done
+    from rpy2 import robjects
+    if not _r_setup_done:
+        robjects.r( R_SETUP )
+        _r_setup_done = True
+    return robjects
+
+
+class StageTimer( object ):
+    """Accumulates the wall time spent in named stages of generating one tool."""
+
+    def __init__( self ):
+        self.stages = {}
+
+    @contextlib.contextmanager
+    def stage( self, name ):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get( name, 0.0 ) + time.perf_counter() - start
+
+
+TIMING_FIELDS = [ 'package', 'rname', 'id', 'status', 'arguments', 'xml_bytes', 'formals', 'hash', 'help', 'classify', 'render', 'write', 'total', 'error' ]
+
+
+def write_timings( path, records ):
+    """Write the per-function timing records as CSV if path ends with .csv, JSON otherwise."""
+    with open( path, 'w' ) as out:
+        if path.endswith( '.csv' ):
+            writer = csv.DictWriter( out, fieldnames=TIMING_FIELDS )
+            writer.writeheader()
+            writer.writerows( records )
+        else:
+            json.dump( records, out, indent=1 )
+
+
+MANIFEST_FILENAME = ".r2g2_manifest.json"
+MANIFEST_FORMAT = 1
+
+
+def get_generator_hash():
+    """Hash of this generator's source, which holds every template (tool_xml, input_not_determined, optional_input, ...)."""
+    with open( os.path.abspath( __file__ ), 'rb' ) as fh:
+        return hashlib.sha256( fh.read() ).hexdigest()
+
+
+def get_function_hash( function_info, help_hash, package_info ):
+    """Content hash of everything that goes into the tool XML of a function."""
+    digest = hashlib.sha256()
+    for key in ( 'r_name', 'package_name', 'package_version', 'galaxy_tool_version', 'generator_hash', 'compact_xml', 'collection_tools', 'release_inputs' ):
+        digest.update( ( '%s=%s\n' % ( key, package_info.get( key ) ) ).encode( 'utf-8' ) )
+    # Only whether there is a cache goes into the tool XML, the directory is in the macros file
+    digest.update( ( 'cache=%s\n' % ( bool( package_info.get( 'cache_dir' ) ) ) ).encode( 'utf-8' ) )
+    digest.update( ( 'rname=%s\nhelp=%s\n' % ( function_info['rname'], help_hash ) ).encode( 'utf-8' ) )
+    for formal in function_info['formals']:
+        digest.update( json.dumps( formal, sort_keys=True ).encode( 'utf-8' ) )
+    return digest.hexdigest()
+
+
+def load_manifest( out_dir, package_info ):
+    """Return the per-function entries of the manifest in out_dir, or {} if it is missing or stale."""
+    try:
+        with open( os.path.join( out_dir, MANIFEST_FILENAME ) ) as fh:
+            manifest = json.load( fh )
+    except ( IOError, ValueError ):
+        return {}
+    if manifest.get( 'format' ) != MANIFEST_FORMAT or manifest.get( 'r_name' ) != package_info['r_name']:
+        return {}
+    return manifest.get( 'functions', {} )
+
+
+def write_json( out_dir, filename, content ):
+    tmp_path = os.path.join( out_dir, "%s.tmp" % ( filename ) )
+    with open( tmp_path, 'w' ) as out:
+        json.dump( content, out, indent=1, sort_keys=True )
+    os.replace( tmp_path, os.path.join( out_dir, filename ) )
+
+
+def write_manifest( out_dir, package_info, functions ):
+    write_json( out_dir, MANIFEST_FILENAME, dict( format=MANIFEST_FORMAT, r_name=package_info['r_name'], functions=functions ) )
+
+
+# Written by a --shard run next to its manifest: what --merge needs to combine the shards of a package
+SHARD_FILENAME = ".r2g2_shard.json"
+SHARD_FORMAT = 1
+
+
+def write_if_changed( path, content ):
+    """Write content to path unless the file already holds exactly that content; returns whether it was written."""
+    try:
+        with open( path ) as fh:
+            if fh.read() == content:
+                return False
+    except IOError:
+        pass
+    with open( path, 'w+' ) as out:
+        out.write( content )
+    return True
+
+
+INDEX_FILENAME = "r2g2_index.json"
+INDEX_FORMAT = 1
+
+
+class ArchiveWriter( object ):
+    """Streams files into a single tar archive, gzip compressed when path ends with .gz."""
+
+    def __init__( self, path, buffer_size=1024 * 1024 ):
+        self.fh = open( path, 'wb', buffering=buffer_size )
+        if path.endswith( '.gz' ):
+            self.archive = tarfile.open( fileobj=self.fh, mode='w:gz', compresslevel=6 )
+        else:
+            self.archive = tarfile.open( fileobj=self.fh, mode='w' )
+        self.mtime = time.time()
+        self.names = []
+
+    def write( self, name, content ):
+        data = content.encode( 'utf-8' )
+        info = tarfile.TarInfo( name )
+        info.size = len( data )
+        info.mtime = self.mtime
+        info.mode = 0o644
+        self.archive.addfile( info, io.BytesIO( data ) )
+        self.names.append( name )
+
+    def close( self ):
+        self.archive.close()
+        self.fh.close()
+
+
+class ThreadedWriter( object ):
+    """Hands writes to a writer running in a background thread, so rendering is not blocked on the filesystem.
+
+    At most max_pending writes are queued; an error in the writer is raised by the next write or by close()."""
+
+    def __init__( self, writer, max_pending=256 ):
+        self.writer = writer
+        self.queue = queue.Queue( max_pending )
+        self.error = None
+        self.thread = threading.Thread( target=self.run )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run( self ):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is None:
+                try:
+                    self.writer.write( *item )
+                except Exception as e:
+                    self.error = e
+
+    def write( self, name, content ):
+        if self.error is not None:
+            raise self.error
+        self.queue.put( ( name, content ) )
+
+    def close( self ):
+        self.queue.put( None )
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+
+def write_output( archive, path, content, if_changed=False ):
+    """Write a generated file into the archive writer, or to path on disk when there is none; returns whether it was written."""
+    if archive is not None:
+        archive.write( path, content )
+    elif if_changed:
+        return write_if_changed( path, content )
+    else:
+        with open( path, 'w+' ) as out:
+            out.write( content )
+    return True
+
+
+def generate_inputs( function_info, compact=False ):
+    """Classify the formals of a function into Galaxy inputs.
+
+    Returns ( inputs, input_names ): the <inputs> XML of each formal, an <expand> of the
+    shared input macros when compact, and a ( formal name, placeholder, input type, use quotes )
+    tuple per input for render_rscript()."""
+    inputs = []
+    input_names = []
+    input_file_name = None
+    for i, formal in enumerate( function_info['formals'] ):
+        formal_name = formal['name']
+        default_value = ''
+        input_type = 'text'
+        input_dict = INPUT_NOT_DETERMINED_DICT.copy()
+        input_dict.update( {
+                      'name': simplify_text( formal_name ),
+                       'label': quoteattr( formal_name ),
+                       'help':quoteattr( formal['shown'].strip() ),
+                       'value': '',
+                       'multiple': False,
+                      } )
+        input_template = optional_input_text
+        use_quotes = True
+        try:
+            r_type = formal['type']
+            if r_type == 'INTSXP':
+                input_type = 'integer'
+                default_value = get_first_value( formal )
+                input_template = optional_input_integer
+                use_quotes = False
+                input_dict[ 'integer_selected' ] = True
+                input_type = 'not_determined'
+            elif r_type == 'LGLSXP': #this seems to have caught NA...FIXME
+                input_type = 'boolean'
+                default_value = get_first_value( formal )
+                input_template = optional_input_boolean
+                use_quotes = False
+                if default_value == 'NULL':
+                    input_dict[ 'NULL_selected' ] = True
+                elif default_value == 'NA':
+                    input_dict[ 'NA_selected' ] = True
+                else:
+                    input_dict[ 'boolean_selected' ] = True
+                input_type = 'not_determined'
+            elif r_type == 'REALSXP':
+                input_type = 'float'
+                default_value = get_first_value( formal )
+                input_template = optional_input_float
+                use_quotes = False
+                input_dict[ 'float_selected' ] = True
+                input_type = 'not_determined'
+            elif r_type == 'STRSXP':
+                input_type = 'text'
+                default_value = get_first_value( formal )
+                input_template = optional_input_text
+                input_dict[ 'text_selected' ] = True
+                input_type = 'not_determined'
             else:
-            #if formal_name not in ['...']:
-                inputs.append( input_template % input_dict )
-                input_names.append( ( formal_name, input_place_name, input_type, use_quotes ) )
+                input_type = 'not_determined'
+                input_template = optional_input_not_determined
+                input_dict[ 'dataset_selected' ] = True
             
-        xml_dict['inputs'] = "        %s" % ( "\n        ".join( inputs ) )    
+            length = formal['length']
+            input_dict['multiple'] = ( length > 1 )
+        except Exception as e:
+            print('Error getting input param info:')
+            print(e)
         
-        xml_dict['rscript_content'] = '%s\nlibrary(%s)\n#set $___USE_COMMA___ = ""\nrval <- %s(' % ( CONFIG_SPLIT_DESIRED_OUTPUTS, r_name, rname )
-        for i, (inp_name, input_placeholder, input_type, use_quotes ) in enumerate( input_names ):
-            if False: #not optional
-            # treating everything as optional atm
-                if input_type == 'dataset':
-                    xml_dict['rscript_content'] = '%s${___USE_COMMA___}\n#set $___USE_COMMA___ = ","\n%s = readRDS("${input_%s}")' % ( xml_dict['rscript_content'], inp_name, input_placeholder )
-                elif input_type == 'not_determined':
-                    xml_dict['rscript_content'] = '''%s${___USE_COMMA___}
-                                                     #if str( $%s_type.%s_type_selector ) != 'skip':
-                                                         #set $___USE_COMMA___ = ","\n
-                                                         #if str( $%s_type.%s_type_selector ) == 'dataset':
-                                                             %s = readRDS("${%s_type.%s}")
-                                                         #elif str( $%s_type.%s_type_selector ) == 'text':
-                                                             %s = "${ %s_type.%s }"
-                                                         #elif str( $%s_type.%s_type_selector ) == 'integer':
-                                                             %s = ${ %s_type.%s }
-                                                         #elif str( $%s_type.%s_type_selector ) == 'float':
-                                                             %s = ${ %s_type.%s }
-                                                         #elif str( $%s_type.%s_type_selector ) == 'boolean':
-                                                             %s = ${ %s_type.%s }
-                                                         #elif str( $%s_type.%s_type_selector ) == 'select':
-                                                             #raise ValueError( 'not implemented' )
-                                                             %s = "${ %s_type.%s }"
-                                                         #elif str( $%s_type.%s_type_selector ) == 'NULL':
-                                                             %s = NULL
-                                                         #end if
-                                                     #end if
-                                                     ''' % ( xml_dict['rscript_content'], 
-                                                          input_placeholder, input_placeholder,
-                                                          input_placeholder, input_placeholder,
-                                                          inp_name, input_placeholder, input_placeholder,
-                                                          input_placeholder, input_placeholder,
-                                                          inp_name, input_placeholder, input_placeholder,
-                                                          input_placeholder, input_placeholder,
-                                                          inp_name, input_placeholder, input_placeholder,
-                                                          input_placeholder, input_placeholder,
-                                                          inp_name, input_placeholder, input_placeholder,
-                                                          input_placeholder, input_placeholder,
-                                                          inp_name, input_placeholder, input_placeholder,
-                                                          input_placeholder, input_placeholder,
-                                                          inp_name, input_placeholder, input_placeholder,
-                                                          input_placeholder, input_placeholder,
-                                                          inp_name,
-                                                          )
-                elif use_quotes:
-                    xml_dict['rscript_content'] = '%s${___USE_COMMA___}\n#set $___USE_COMMA___ = ","\n%s = "${ %s }"' % ( xml_dict['rscript_content'], inp_name, input_placeholder )
-                else:
-                    xml_dict['rscript_content'] = '%s${___USE_COMMA___}\n#set $___USE_COMMA___ = ","\n%s = ${ %s }' % ( xml_dict['rscript_content'], inp_name, input_placeholder )
-            else:
-                # is optional
-                if input_type == 'ellipsis':
-                    dict( name='argument'  )
-                    xml_dict['rscript_content'] = '''%s${___USE_COMMA___}
-                                                #set $___USE_COMMA___ = ","
-                                                #for eli in $___ellipsis___:
-                                                    #if str( $eli.argument_type.argument_type_selector ) != 'skip':
-                                                         #set $___USE_COMMA___ = ","\n
-                                                         #if str( $eli.argument_type.argument_type_selector ) == 'dataset':
-                                                             ${eli.argument_name} = readRDS("${eli.argument_type.argument}")
-                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'text':
-                                                             ${eli.argument_name} = "${eli.argument_type.argument}"
-                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'integer':
-                                                             ${eli.argument_name} = ${eli.argument_type.argument}
-                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'float':
-                                                             ${eli.argument_name} = ${eli.argument_type.argument}
-                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'boolean':
-                                                             ${eli.argument_name} = ${eli.argument_type.argument}
-                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'select':
-                                                             #raise ValueError( 'not implemented' )
-                                                             ${eli.argument_name} = "${eli.argument_type.argument}"
-                                                         #elif str( $eli.argument_type.argument_type_selector ) == 'NULL':
-                                                             ${eli.argument_name} = NULL
-                                                         #end if
-                                                     #end if
-                                                #end for
-                                                ''' % ( xml_dict['rscript_content'] )
-                else:                                                                 
-                    xml_dict['rscript_content'] = '%s\n#if str( $%s_type.%s_type_selector ) == "True":\n' % ( xml_dict['rscript_content'], input_placeholder, input_placeholder )
-                    if input_type == 'dataset':
-                        xml_dict['rscript_content'] = '%s${___USE_COMMA___}\n#set $___USE_COMMA___ = ","\n%s = readRDS("${input_%s}")' % ( xml_dict['rscript_content'], inp_name, input_placeholder )
-                    elif input_type == 'not_determined':
-                        xml_dict['rscript_content'] = '''%s${___USE_COMMA___}
-                                                         #if str( $%s_type.%s_type.%s_type_selector ) != 'skip':
-                                                             #set $___USE_COMMA___ = ","\n
-                                                             #if str( $%s_type.%s_type.%s_type_selector ) == 'dataset':
-                                                                 %s = readRDS("${%s_type.%s_type.%s}")
-                                                             #elif str( $%s_type.%s_type.%s_type_selector ) == 'text':
-                                                                 %s = "${ %s_type.%s_type.%s }"
-                                                             #elif str( $%s_type.%s_type.%s_type_selector ) == 'integer':
-                                                                 %s = ${ %s_type.%s_type.%s }
-                                                             #elif str( $%s_type.%s_type.%s_type_selector ) == 'float':
-                                                                 %s = ${ %s_type.%s_type.%s }
-                                                             #elif str( $%s_type.%s_type.%s_type_selector ) == 'boolean':
-                                                                 %s = ${ %s_type.%s_type.%s }
-                                                             #elif str( $%s_type.%s_type.%s_type_selector ) == 'select':
-                                                                 #raise ValueError( 'not implemented' )
-                                                                 %s = "${ %s_type.%s_type.%s }"
-                                                             #elif str( $%s_type.%s_type.%s_type_selector ) == 'NULL':
-                                                                 %s = NULL
-                                                             #end if
-                                                         #end if
-                                                         ''' % ( xml_dict['rscript_content'], 
-                                                              input_placeholder, input_placeholder, input_placeholder,
-                                                              input_placeholder, input_placeholder, input_placeholder,
-                                                              inp_name, input_placeholder, input_placeholder, input_placeholder,
-                                                              input_placeholder, input_placeholder, input_placeholder,
-                                                              inp_name, input_placeholder, input_placeholder, input_placeholder,
-                                                              input_placeholder, input_placeholder, input_placeholder,
-                                                              inp_name, input_placeholder, input_placeholder, input_placeholder,
-                                                              input_placeholder, input_placeholder, input_placeholder,
-                                                              inp_name, input_placeholder, input_placeholder, input_placeholder,
-                                                              input_placeholder, input_placeholder, input_placeholder,
-                                                              inp_name, input_placeholder, input_placeholder, input_placeholder,
-                                                              input_placeholder, input_placeholder, input_placeholder,
-                                                              inp_name, input_placeholder, input_placeholder, input_placeholder,
-                                                              input_placeholder, input_placeholder, input_placeholder,
-                                                              inp_name,
-                                                              )
-                    elif use_quotes:
-                        xml_dict['rscript_content'] = '%s${___USE_COMMA___}\n#set $___USE_COMMA___ = ","\n%s = "${ %s_type.%s }"' % ( xml_dict['rscript_content'], inp_name, input_placeholder, input_placeholder )
-                    else:
-                        xml_dict['rscript_content'] = '%s${___USE_COMMA___}\n#set $___USE_COMMA___ = ","\n%s = ${ %s_type.%s }' % ( xml_dict['rscript_content'], inp_name, input_placeholder, input_placeholder )
-                    xml_dict['rscript_content'] = '%s\n#end if\n' % ( xml_dict['rscript_content'] )
-        xml_dict['rscript_content'] = '%s\n)%s' % ( xml_dict['rscript_content'], SAVE_R_OBJECT_TEXT )
         
         
-        assert rname not in package_dict, "%s already exists!" % (package_dict)
-        package_dict[rname] = xml_dict
-        with open( os.path.join( args.out, "%s.xml" % ( xml_dict['id_underscore'] ) ), 'w+' ) as out:
-            out.write( tool_xml % xml_dict )
-        print("Created: %s" % ( os.path.join( args.out, "%s.xml" % ( xml_dict['id_underscore'] ) ) ))
+        if formal_name in BPPARAM_FORMALS or ( formal_name in SLOTS_FORMALS and formal.get( 'type' ) not in ( 'STRSXP', 'LGLSXP' ) ):
+            input_type = 'bpparam' if formal_name in BPPARAM_FORMALS else 'slots'
+            input_template = slots_input
+        elif input_type == 'dataset':
+            input_template = optional_input_dataset
+        elif input_type == 'boolean':
+            default_value = str( ( default_value.strip().lower() == 'true' ) )
         
+        input_dict['value'] = quoteattr( default_value )
+        input_place_name = input_dict['name']
+        
+        
+        #FIXME: change ... into repeat with conditional to allow providing any? type of input, with/without names?
+        if formal_name in ['...']:
+            print('has ... need to replace with a repeat and conditional')
+            inputs.append( render_input_expand( ellipsis_input, input_dict ) if compact else ellipsis_input % input_dict )
+            input_names.append( ( '...', '___ellipsis___', 'ellipsis', False ) )
+        else:
+        #if formal_name not in ['...']:
+            inputs.append( render_input_expand( input_template, input_dict ) if compact else input_template % input_dict )
+            input_names.append( ( formal_name, input_place_name, input_type, use_quotes ) )
+        
+    return inputs, input_names
+
+
+def render_rscript_arguments( input_names, prefix='', pipeline=False, compact=False, bind=False ):
+    """Rscript fragments passing the inputs in input_names as arguments.
+
+    prefix is prepended to every Cheetah placeholder, e.g. to reach inputs nested in a repeat.
+    With pipeline, an argument receiving the result of the previous step is not passed again.
+    With compact, inputs of undetermined type call the r2g2_argument() #def instead of inlining it.
+    With bind, the fragments binding the dataset arguments, to go before the call, are returned instead."""
+    fragments = []
+    for inp_name, input_placeholder, input_type, use_quotes in input_names:
+        values = dict( name=inp_name, placeholder=input_placeholder, prefix=prefix, name_literal=repr( inp_name ), name_string=json.dumps( inp_name ), placeholder_literal=repr( input_placeholder ) )
+        if bind:
+            if input_type == 'ellipsis':
+                fragments.append( RSCRIPT_BIND_ELLIPSIS % values )
+            elif input_type in RSCRIPT_BIND_ARGUMENT:
+                if pipeline:
+                    fragments.append( PIPELINE_ARGUMENT_START % values )
+                fragments.append( RSCRIPT_OPTIONAL_START % values )
+                fragments.append( RSCRIPT_BIND_ARGUMENT[input_type] % values )
+                fragments.append( RSCRIPT_OPTIONAL_END )
+                if pipeline:
+                    fragments.append( RSCRIPT_OPTIONAL_END )
+            continue
+        # treating everything as optional atm
+        if input_type == 'ellipsis':
+            fragments.append( ( RSCRIPT_COMPACT_ELLIPSIS if compact else RSCRIPT_ELLIPSIS ) % values )
+            continue
+        if input_type in RSCRIPT_SLOTS_ARGUMENT:
+            # not optional: the selector has its own skip option
+            if pipeline:
+                fragments.append( PIPELINE_ARGUMENT_START % values )
+            fragments.append( RSCRIPT_SLOTS_ARGUMENT[input_type] % values )
+            if pipeline:
+                fragments.append( RSCRIPT_OPTIONAL_END )
+            continue
+        if compact and input_type == 'not_determined':
+            argument = RSCRIPT_COMPACT_NOT_DETERMINED
+        elif input_type in ( 'dataset', 'not_determined' ):
+            argument = RSCRIPT_OPTIONAL_ARGUMENT[input_type]
+        elif use_quotes:
+            argument = RSCRIPT_OPTIONAL_ARGUMENT['quoted']
+        else:
+            argument = RSCRIPT_OPTIONAL_ARGUMENT['unquoted']
+        if pipeline:
+            fragments.append( PIPELINE_ARGUMENT_START % values )
+        fragments.append( RSCRIPT_OPTIONAL_START % values )
+        fragments.append( argument % values )
+        fragments.append( RSCRIPT_OPTIONAL_END )
+        if pipeline:
+            fragments.append( RSCRIPT_OPTIONAL_END )
+    return fragments
+
+
+def render_rscript( r_name, rname, input_names, compact=False, release=False, cache=False ):
+    """Render the configfile Rscript calling rname: the dataset bindings, then the call, over input_names.
+
+    With release, the dataset bindings are removed once the call returns.
+    With cache, the result is looked up in the result cache of @RSCRIPT_CACHE@ before calling rname, and stored there after."""
+    values = dict( r_name=r_name, rname=rname, rname_string=json.dumps( rname ) )
+    fragments = [ RSCRIPT_HEADER % values ]
+    if compact:
+        fragments.insert( 0, RSCRIPT_ARGUMENT_DEF )
+    fragments.extend( render_rscript_arguments( input_names, bind=True ) )
+    fragments.append( ( RSCRIPT_CACHED_CALL_START if cache else RSCRIPT_CALL_START ) % values )
+    fragments.extend( render_rscript_arguments( input_names, compact=compact ) )
+    if cache:
+        fragments.append( RSCRIPT_CACHED_CALL_END % values )
+    else:
+        fragments.append( RSCRIPT_CALL_END )
+        fragments.append( RSCRIPT_RESULT_SIZE )
+    if release:
+        fragments.append( RSCRIPT_RELEASE_INPUTS )
+    fragments.append( RSCRIPT_CACHED_FOOTER if cache else RSCRIPT_FOOTER )
+    return ''.join( fragments )
+
+
+def render_tool_xml( function_info, package_info, help_rst='', description='', timer=None ):
+    """Render the Galaxy tool XML of one function.
+
+    function_info is a dict as returned by introspect_package(); no R session is needed.
+    Returns ( tool id, xml )."""
+    timer = timer or StageTimer()
+    rname = function_info['rname']
+    xml_dict = {
+                'package_name': package_info['package_name'],
+                'id': "%s_%s" % ( package_info['package_name'], rname ),
+                'galaxy_tool_version': package_info['galaxy_tool_version'],
+                'name': "%s" % ( rname ),
+                'description': description,
+                'inputs': '',
+                'rscript_content': '',
+                'outputs': '',
+                'help_rst': help_rst,
+                'r_name': package_info['r_name'],
+                }
+    xml_dict['id_underscore'] = simplify_text( xml_dict['id'] )
+    xml_dict['id'] = simplify_text( xml_dict['id'] ) # ToolShed doesn't like e.g. '-'' in ids
+
+    with timer.stage( 'classify' ):
+        inputs, input_names = generate_inputs( function_info, package_info.get( 'compact_xml' ) )
+    with timer.stage( 'render' ):
+        xml_dict['inputs'] = "        %s" % ( "\n        ".join( inputs ) )
+        xml_dict['rscript_content'] = render_rscript( package_info['r_name'], rname, input_names, package_info.get( 'compact_xml' ), package_info.get( 'release_inputs' ),
+                                                   bool( package_info.get( 'cache_dir' ) ) )
+        xml = tool_xml % xml_dict
+    return xml_dict['id_underscore'], xml
+
+
+def get_pipeline_tool_id( package_info ):
+    return simplify_text( "%s_r2g2_pipeline" % ( package_info['package_name'] ) )
+
+
+def render_pipeline_tool_xml( functions, package_info ):
+    """Render the pipeline tool of a package, chaining any of functions in a single R session.
+
+    Each step reuses the inputs of the function's own tool and may pass the result of the
+    previous step as one of its arguments, so intermediate results are not serialized.
+    Returns ( tool id, xml )."""
+    tool_id = get_pipeline_tool_id( package_info )
+    options = []
+    whens = []
+    compact = package_info.get( 'compact_xml' )
+    fragments = [ PIPELINE_RSCRIPT_HEADER % dict( r_name=package_info['r_name'] ) ]
+    if compact:
+        fragments.insert( 0, RSCRIPT_ARGUMENT_DEF )
+    for i, function_info in enumerate( functions ):
+        rname = function_info['rname']
+        inputs, input_names = generate_inputs( function_info, compact )
+        pass_previous = [ '<option value="___none___">Do not pass it</option>' ]
+        for inp_name, input_placeholder, input_type, use_quotes in input_names:
+            if input_type != 'ellipsis':
+                pass_previous.append( '<option value=%s selected="%s">%s</option>' % ( quoteattr( inp_name ), len( pass_previous ) == 1, escape( inp_name ) ) )
+        values = dict( rname=rname,
+                       value=quoteattr( rname ),
+                       label=escape( rname ),
+                       rname_literal=repr( rname ),
+                       rname_string=json.dumps( rname ),
+                       keyword='if' if i == 0 else 'elif',
+                       pass_previous="\n                        ".join( pass_previous ),
+                       inputs="\n                    ".join( inputs ) )
+        options.append( PIPELINE_FUNCTION_OPTION % values )
+        whens.append( PIPELINE_FUNCTION_WHEN % values )
+        fragments.append( PIPELINE_STEP_START % values )
+        fragments.extend( render_rscript_arguments( input_names, prefix='___step___.step.', pipeline=True, bind=True ) )
+        fragments.append( PIPELINE_CALL_START % values )
+        fragments.extend( render_rscript_arguments( input_names, prefix='___step___.step.', pipeline=True, compact=compact ) )
+        fragments.append( RSCRIPT_CALL_END )
+        if package_info.get( 'release_inputs' ):
+            fragments.append( RSCRIPT_RELEASE_INPUTS )
+        fragments.append( PIPELINE_STEP_END % values )
+    fragments.append( PIPELINE_RSCRIPT_FOOTER )
+    xml_dict = dict( id=tool_id,
+                     id_underscore=tool_id,
+                     r_name=package_info['r_name'],
+                     galaxy_tool_version=package_info['galaxy_tool_version'],
+                     function_options="\n".join( options ),
+                     function_whens="".join( whens ),
+                     rscript_content=''.join( fragments ) )
+    return tool_id, pipeline_tool_xml % xml_dict
+
+
+def get_collection_formal( function_info ):
+    """The formal a collection variant passes each element as: the first one taking a dataset by default, or None."""
+    for formal in function_info['formals']:
+        if formal['name'] == '...' or formal['name'] in SLOTS_FORMALS or formal['name'] in BPPARAM_FORMALS:
+            continue
+        if formal['type'] not in ( 'INTSXP', 'LGLSXP', 'REALSXP', 'STRSXP' ):
+            return formal['name']
+    return None
+
+
+def render_collection_tool_xml( function_info, package_info, help_rst='', description='', timer=None ):
+    """Render the collection variant of the tool of one function, mapping it over a list collection in one R session.
+
+    The first formal taking a dataset is replaced by the collection; each element is passed as it in turn.
+    Returns ( tool id, xml ), or None when the function has no such formal."""
+    timer = timer or StageTimer()
+    rname = function_info['rname']
+    collection_formal = get_collection_formal( function_info )
+    if collection_formal is None:
+        return None
+    compact = package_info.get( 'compact_xml' )
+    tool_id = simplify_text( "%s_%s_collection" % ( package_info['package_name'], rname ) )
+    with timer.stage( 'classify' ):
+        inputs, input_names = generate_inputs( function_info, compact )
+        position = [ input_name[0] for input_name in input_names ].index( collection_formal )
+        collection_placeholder = input_names[position][1]
+        del inputs[position]
+        del input_names[position]
+    with timer.stage( 'render' ):
+        values = dict( r_name=package_info['r_name'], rname=rname, name=collection_formal, placeholder=collection_placeholder, id_underscore=tool_id )
+        fragments = [ COLLECTION_RSCRIPT_HEADER % values ]
+        if compact:
+            fragments.insert( 0, RSCRIPT_ARGUMENT_DEF )
+        fragments.extend( render_rscript_arguments( input_names, bind=True ) )
+        fragments.append( COLLECTION_CALL_START % values )
+        fragments.extend( render_rscript_arguments( input_names, compact=compact ) )
+        fragments.append( COLLECTION_CALL_END )
+        if package_info.get( 'release_inputs' ):
+            fragments.append( COLLECTION_RELEASE_INPUT % values )
+        fragments.append( COLLECTION_RSCRIPT_FOOTER )
+        xml_dict = dict( id=tool_id,
+                         id_underscore=tool_id,
+                         name="%s on a collection" % ( rname ),
+                         rname=rname,
+                         description=description,
+                         galaxy_tool_version=package_info['galaxy_tool_version'],
+                         r_name=package_info['r_name'],
+                         collection_placeholder=collection_placeholder,
+                         collection_label=quoteattr( "%s (collection)" % ( collection_formal ) ),
+                         collection_help=quoteattr( "Each element is passed as %s in turn" % ( collection_formal ) ),
+                         inputs="        %s" % ( "\n        ".join( inputs ) ),
+                         rscript_content=''.join( fragments ),
+                         help_rst=help_rst )
+        xml = collection_tool_xml % xml_dict
+    return tool_id, xml
+
+
+def generate_tool_xml( function_info, package_info, package_help, timer=None ):
+    """Look up the help of one function and render its tool XML, and with collection_tools its collection variant.
+
+    Returns ( tool id, xml, collection ), collection being None or as returned by render_collection_tool_xml()."""
+    timer = timer or StageTimer()
+    rname = function_info['rname']
+    with timer.stage( 'help' ):
+        if package_help.get_rd_file( rname ) is None:
+            print("No help page for %s, using the signature" % ( rname ))
+            help_rst, description = get_signature_rst( function_info ), ''
+        else:
+            try:
+                help_rst, description = package_help.get_help( rname )
+            except Exception as e:
+                print("Falling back to docstring:", rname, e)
+                help_rst, description = get_signature_rst( function_info ), ''
+    tool_id, xml = render_tool_xml( function_info, package_info, help_rst, description, timer )
+    collection = None
+    if package_info.get( 'collection_tools' ):
+        collection = render_collection_tool_xml( function_info, package_info, help_rst, description, timer )
+    return tool_id, xml, collection
+
+
+def process_function( package_help, j, function_info, package_info, previous ):
+    """Render the tool XML for a single function, as returned by introspect_package().
+
+    Returns a dict with the status ('created', 'unchanged', 'skipped' or 'error') and, when created, the xml.
+    Functions whose hash matches previous, their entry in the manifest, are not looked up or rendered again."""
+    rname = function_info['rname']
+    print('Starting',j,rname)
+    timer = StageTimer()
+    rval = dict( j=j, name=rname, rname=rname, id_underscore=None, hash=None, xml=None, collection_id=None, collection_xml=None,
+                 error=None, timings=timer.stages, arguments=len( function_info['formals'] ) )
+    try:
+        if '.' in rname and False:
+            print("Skipping:", rname)
+            rval['status'] = 'skipped'
+        else:
+            with timer.stage( 'hash' ):
+                rval['hash'] = get_function_hash( function_info, package_help.get_hash( rname ), package_info )
+            if previous and previous['hash'] == rval['hash'] and all( os.path.exists( os.path.join( package_info['out'], "%s.xml" % ( tool_id ) ) )
+                                                                      for tool_id in ( previous['id'], previous.get( 'collection_id' ) ) if tool_id ):
+                rval['id_underscore'] = previous['id']
+                rval['collection_id'] = previous.get( 'collection_id' )
+                rval['status'] = 'unchanged'
+            else:
+                rval['id_underscore'], rval['xml'], collection = generate_tool_xml( function_info, package_info, package_help, timer )
+                if collection is not None:
+                    rval['collection_id'], rval['collection_xml'] = collection
+                rval['status'] = 'created'
     except Exception as e:
-        print('uncaught error in %i: %s\n%s' % ( j, name, e ))
-        skipped += 1
-    print('Ending',j,name)
-#print package_dict
-print('')
-print('created', len(package_dict) + int(args.create_load_matrix_tool), 'tool XMLs')
-print('skipped', skipped, 'functions')
+        rval['error'] = str( e )
+        rval['status'] = 'error'
+    print('Ending',j,rname)
+    return rval
+
+
+# Each worker process owns its own embedded R, as R can not be shared between threads.
+# Workers live for the whole run and keep the help of the package they are working on.
+_worker_package_help = {}
+
+
+def get_package_help( package_info, cache ):
+    """PackageHelp for the package, or SnapshotHelp when rendering from a snapshot.
+
+    Packages are generated one after the other, so the help of the previous package is dropped from cache."""
+    key = ( package_info['r_name'], package_info.get( 'snapshot' ) )
+    if key not in cache:
+        cache.clear()
+        if package_info.get( 'snapshot' ):
+            cache[key] = SnapshotHelp( load_snapshot( package_info['snapshot'] )[package_info['r_name']] )
+        else:
+            cache[key] = PackageHelp( package_info['r_name'] )
+    return cache[key]
+
+
+def process_functions_in_worker( tasks ):
+    results = []
+    for j, function_info, package_info, previous in tasks:
+        package_help = get_package_help( package_info, _worker_package_help )
+        results.append( process_function( package_help, j, function_info, package_info, previous ) )
+    return results
+
+
+def create_pool( jobs ):
+    """Pool of jobs worker processes, or None to generate in this process."""
+    if jobs <= 1:
+        return None
+    # Use spawn, not fork: forking a process that has already started embedded R is unsafe
+    return multiprocessing.get_context( 'spawn' ).Pool( jobs )
+
+
+def run_supervised_worker( conn ):
+    """Main loop of a SupervisedWorkers process: process_function on each task received on conn, until None.
+
+    ( 'started', j ) is sent once the package help is loaded, so loading it does not count against the time limit."""
+    while True:
+        task = conn.recv()
+        if task is None:
+            return
+        j, function_info, package_info, previous = task
+        package_help = get_package_help( package_info, _worker_package_help )
+        conn.send( ( 'started', j ) )
+        conn.send( ( 'result', process_function( package_help, j, function_info, package_info, previous ) ) )
+
+
+class SupervisedWorkers( object ):
+    """Worker processes rendering one function at a time, each under a time limit of timeout seconds.
+
+    A worker exceeding the limit is killed and replaced, as is one that dies (e.g. crashing in embedded R);
+    its function is reported as skipped, with the reason as error, and the run goes on."""
+
+    def __init__( self, jobs, timeout ):
+        # spawn, as for create_pool()
+        self.context = multiprocessing.get_context( 'spawn' )
+        self.timeout = timeout
+        self.workers = [ self.start_worker() for i in range( jobs ) ]
+
+    def start_worker( self ):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process( target=run_supervised_worker, args=( child_conn, ) )
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        return dict( process=process, conn=conn, task=None, deadline=None )
+
+    def replace_worker( self, worker ):
+        worker['conn'].close()
+        if worker['process'].is_alive():
+            worker['process'].kill()
+        worker['process'].join()
+        self.workers[self.workers.index( worker )] = self.start_worker()
+
+    def dispatch( self, i, task ):
+        """Send task to worker i, replacing the worker first if it died since its last task."""
+        try:
+            self.workers[i]['conn'].send( task )
+        except ( OSError, EOFError ):
+            self.replace_worker( self.workers[i] )
+            self.workers[i]['conn'].send( task )
+        self.workers[i]['task'] = task
+        self.workers[i]['deadline'] = None
+
+    def failed_result( self, task, reason ):
+        j, function_info, package_info, previous = task
+        return dict( j=j, name=function_info['rname'], rname=function_info['rname'], id_underscore=None, hash=None, xml=None,
+                     collection_id=None, collection_xml=None, error=reason, timings={}, arguments=len( function_info['formals'] ), status='skipped' )
+
+    def imap_unordered( self, tasks ):
+        """Yield the process_function result of each task as it completes, or a skipped result."""
+        tasks = iter( tasks )
+        pending = True
+        while True:
+            for i, worker in enumerate( self.workers ):
+                if pending and worker['task'] is None:
+                    task = next( tasks, None )
+                    if task is None:
+                        pending = False
+                    else:
+                        self.dispatch( i, task )
+            busy = [ worker for worker in self.workers if worker['task'] is not None ]
+            if not busy:
+                return
+            deadlines = [ worker['deadline'] for worker in busy if worker['deadline'] is not None ]
+            wait = max( 0, min( deadlines ) - time.monotonic() ) if deadlines else None
+            ready = multiprocessing.connection.wait( [ worker['conn'] for worker in busy ], wait )
+            for worker in busy:
+                if worker['conn'] in ready:
+                    try:
+                        message, value = worker['conn'].recv()
+                    except ( OSError, EOFError ):
+                        task = worker['task']
+                        self.replace_worker( worker )
+                        yield self.failed_result( task, "worker died (exit code %s)" % ( worker['process'].exitcode ) )
+                        continue
+                    if message == 'started':
+                        worker['deadline'] = time.monotonic() + self.timeout
+                    else:
+                        worker['task'] = None
+                        yield value
+                elif worker['deadline'] is not None and time.monotonic() >= worker['deadline']:
+                    task = worker['task']
+                    self.replace_worker( worker )
+                    yield self.failed_result( task, "timed out after %s seconds" % ( self.timeout ) )
+
+    def reset( self ):
+        """Replace the workers still busy with tasks whose results will not be consumed, e.g. of a package that failed."""
+        for worker in list( self.workers ):
+            if worker['task'] is not None:
+                self.replace_worker( worker )
+
+    def close( self ):
+        for worker in self.workers:
+            try:
+                worker['conn'].send( None )
+            except ( OSError, EOFError ):
+                pass
+
+    def join( self ):
+        for worker in self.workers:
+            worker['process'].join( 5 )
+            if worker['process'].is_alive():
+                worker['process'].kill()
+                worker['process'].join()
+            worker['conn'].close()
+
+
+MAX_CHUNKSIZE = 16
+
+
+def iter_results( pool, jobs, package_help_cache, functions, package_info, manifest ):
+    """Yield process_function results in order, on the pool's worker processes if there is one.
+
+    Chunks of tasks are submitted as results are consumed, at most two per worker in flight,
+    so the rendered XML waiting to be written does not grow with the size of the package.
+    SupervisedWorkers yield each result as it completes instead, in any order."""
+    tasks = ( ( j, function_info, package_info, manifest.get( function_info['rname'] ) ) for j, function_info in enumerate( functions ) )
+    if pool is None:
+        package_help = get_package_help( package_info, package_help_cache )
+        for task in tasks:
+            yield process_function( package_help, *task )
+        return
+    if isinstance( pool, SupervisedWorkers ):
+        for result in pool.imap_unordered( tasks ):
+            yield result
+        return
+    chunksize = max( 1, min( MAX_CHUNKSIZE, len( functions ) // ( jobs * 4 ) ) )
+    pending = collections.deque()
+    while True:
+        chunk = list( itertools.islice( tasks, chunksize ) )
+        if chunk:
+            pending.append( pool.apply_async( process_functions_in_worker, ( chunk, ) ) )
+        if not pending:
+            return
+        if not chunk or len( pending ) >= jobs * 2:
+            for result in pending.popleft().get():
+                yield result
+
+
+def generate_package( package_args, args, pool, package_help_cache, timing_records, archive=None ):
+    """Generate the tools of one R package into package_args['out']; returns a summary dict.
+
+    The package is introspected in R, or read from the --render snapshot without R. Each tool is
+    written as soon as it is rendered and only a small summary of it is kept (id, path, hash, status).
+    A timing record per function is appended to timing_records. With an archive writer,
+    package_args['out'] is the directory inside the archive and every tool is written."""
+    r_name = package_args['name']
+    out_dir = package_args['out']
+    print('Generating tools for', r_name, 'in', out_dir)
+    start = time.perf_counter()
+    if args.render:
+        package_snapshot = load_snapshot( args.render )[r_name]
+        r_package_version = package_snapshot['version']
+        functions = [ function_info for function_info in package_snapshot['functions'] if args.function_filter( function_info['rname'] ) ]
+    else:
+        r_package_version, functions = introspect_selected_functions( r_name, args.function_filter )
+    # A single R call introspects every function, so each gets an equal share of it
+    formals_time = ( time.perf_counter() - start ) / max( 1, len( functions ) )
+
+    package_info = dict( r_name=r_name,
+                         package_name=package_args['package_name'] or r_name,
+                         package_version=package_args['package_version'] or r_package_version,
+                         galaxy_tool_version=args.galaxy_tool_version,
+                         out=out_dir,
+                         snapshot=args.render,
+                         rds_version=args.rds_version,
+                         rds_compress=args.rds_compress,
+                         rds_compression_level=args.rds_compression_level,
+                         compact_xml=args.compact_xml,
+                         collection_tools=args.create_collection_tools,
+                         release_inputs=args.release_inputs,
+                         cache_dir=args.cache_dir,
+                         cache_max_size=args.cache_max_size )
+    package_info['generator_hash'] = get_generator_hash()
+
+    tool_summaries = {}
+    pipeline_functions = []
+    skipped = 0
+    # Every tool is written to a file named after its id, which several names can simplify to, e.g. a.b and a_b
+    tool_rnames = get_package_tool_ids( package_info, args.create_load_matrix_tool, args.create_pipeline_tool )
+    collisions = []
+    if archive is None:
+        try:
+            os.makedirs( out_dir )
+        except os.error:
+            pass
+
+    previous_manifest = {} if archive is not None else load_manifest( out_dir, package_info )
+    manifest = {} if args.force else previous_manifest
+
+    write_output( archive, os.path.join( out_dir, "%s_macros.xml" % ( r_name ) ), generate_macro_xml( package_info ), if_changed=True )
+
+    # Whether each package wide tool (load matrix, pipeline) was written, or left as it was
+    package_tools_written = []
+    if args.create_load_matrix_tool:
+        package_tools_written.append( write_output( archive, os.path.join( out_dir, "r_load_matrix.xml" ), generate_LOAD_MATRIX_TOOL_XML( package_info ), if_changed=True ) )
+
+    for result in iter_results( pool, args.jobs, package_help_cache, functions, package_info, manifest ):
+        record = dict( package=r_name, rname=result['rname'], id=result['id_underscore'], status=result['status'],
+                       arguments=result['arguments'], xml_bytes=len( result['xml'] or '' ) + len( result['collection_xml'] or '' ),
+                       error=result['error'], formals=formals_time, **result['timings'] )
+        timing_records.append( record )
+        try:
+            if result['status'] == 'skipped':
+                if result['error'] is not None:
+                    print("Skipped: %s (%s)" % ( result['rname'], result['error'] ))
+                skipped += 1
+                continue
+            if result['error'] is not None:
+                raise Exception( result['error'] )
+            rname = result['rname']
+            tool_collisions = claim_tool_ids( tool_rnames, rname, [ result['id_underscore'] ] )
+            if result['collection_id']:
+                # <id>_collection is also the id of the tool of a function named <rname>_collection
+                tool_collisions.extend( claim_tool_ids( tool_rnames, "the collection tool of %s" % ( rname ), [ result['collection_id'] ] ) )
+            if tool_collisions:
+                # Not written over the other tool; the package fails once every function is done
+                collisions.extend( tool_collisions )
+                raise ValueError( '; '.join( tool_collisions ) )
+            path = os.path.join( out_dir, "%s.xml" % ( result['id_underscore'] ) )
+            collection_path = os.path.join( out_dir, "%s.xml" % ( result['collection_id'] ) ) if result['collection_id'] else None
+            tool_summaries[rname] = dict( id=result['id_underscore'], path=path, hash=result['hash'], status=result['status'],
+                                          collection_id=result['collection_id'], collection_path=collection_path )
+            if args.create_pipeline_tool:
+                pipeline_functions.append( functions[result['j']] )
+            if result['status'] == 'unchanged':
+                print("Unchanged: %s" % ( path ))
+                continue
+            start = time.perf_counter()
+            write_output( archive, path, result['xml'] )
+            if collection_path:
+                write_output( archive, collection_path, result['collection_xml'] )
+            record['write'] = time.perf_counter() - start
+            print("Created: %s" % ( path ))
+            if collection_path:
+                print("Created: %s" % ( collection_path ))
+        except Exception as e:
+            print('uncaught error in %i: %s\n%s' % ( result['j'], result['name'], e ))
+            record['status'] = 'error'
+            record['error'] = str( e )
+            skipped += 1
+        finally:
+            record['total'] = sum( record.get( stage ) or 0.0 for stage in ( 'formals', 'hash', 'help', 'classify', 'render', 'write' ) )
+    if collisions:
+        raise ValueError( '; '.join( collisions ) )
+    # A shard only sees some of the functions, its pipeline tool is rendered by --merge
+    if args.create_pipeline_tool and pipeline_functions and not args.shard:
+        # By name in code point order, whatever the order of the snapshot or of --function_timeout results, like --merge
+        pipeline_functions.sort( key=lambda function_info: function_info['rname'] )
+        pipeline_id, pipeline_xml = render_pipeline_tool_xml( pipeline_functions, package_info )
+        package_tools_written.append( write_output( archive, os.path.join( out_dir, "%s.xml" % ( pipeline_id ) ), pipeline_xml, if_changed=True ) )
+        print("%s: %s" % ( "Created" if package_tools_written[-1] else "Unchanged", os.path.join( out_dir, "%s.xml" % ( pipeline_id ) ) ))
+    if archive is None:
+        # Functions left out by --include/--exclude/--functions_from keep their entries from the previous run
+        new_manifest = dict( ( rname, entry ) for rname, entry in previous_manifest.items() if not args.function_filter( rname ) )
+        new_manifest.update( ( rname, dict( hash=summary['hash'], id=summary['id'], collection_id=summary['collection_id'] ) ) for rname, summary in tool_summaries.items() )
+        write_manifest( out_dir, package_info, new_manifest )
+    if args.shard:
+        write_json( out_dir, SHARD_FILENAME, dict( format=SHARD_FORMAT,
+                                                   shard=list( args.shard ),
+                                                   package_info=package_info,
+                                                   skipped=skipped,
+                                                   tools=dict( ( rname, summary['id'] ) for rname, summary in tool_summaries.items() ),
+                                                   collection_tools=dict( ( rname, summary['collection_id'] ) for rname, summary in tool_summaries.items() if summary['collection_id'] ),
+                                                   load_matrix_tool=args.create_load_matrix_tool,
+                                                   pipeline_functions=pipeline_functions if args.create_pipeline_tool else None ) )
+    unchanged = sum( 1 + int( bool( summary['collection_id'] ) ) for summary in tool_summaries.values() if summary['status'] == 'unchanged' )
+    created = sum( 1 + int( bool( summary['collection_id'] ) ) for summary in tool_summaries.values() if summary['status'] != 'unchanged' )
+    created += sum( package_tools_written )
+    unchanged += len( package_tools_written ) - sum( package_tools_written )
+    print('')
+    print('created', created, 'tool XMLs')
+    print('unchanged', unchanged, 'tool XMLs')
+    print('skipped', skipped, 'functions')
+    return dict( r_name=r_name, out=out_dir, created=created, unchanged=unchanged, skipped=skipped, error=None,
+                 package_version=package_info['package_version'],
+                 tools=dict( ( rname, summary['path'] ) for rname, summary in tool_summaries.items() ),
+                 collection_tools=dict( ( rname, summary['collection_path'] ) for rname, summary in tool_summaries.items() if summary['collection_path'] ) )
+
+
+def get_package_tool_ids( package_info, load_matrix_tool, pipeline_tool ):
+    """The tool ids of the package wide tools, as a dict of tool id to a description of the tool."""
+    tool_ids = {}
+    if load_matrix_tool:
+        tool_ids['r_load_matrix'] = 'the load matrix tool'
+    if pipeline_tool:
+        tool_ids[get_pipeline_tool_id( package_info )] = 'the pipeline tool'
+    return tool_ids
+
+
+def claim_tool_ids( tool_rnames, rname, tool_ids ):
+    """Record in tool_rnames, a dict of tool id to what renders to it, that rname renders to tool_ids.
+
+    Tools are written to files named after their id, so returns a message for each id that is already taken."""
+    collisions = []
+    for tool_id in tool_ids:
+        if tool_id in tool_rnames:
+            collisions.append( "%s and %s both render to %s.xml" % ( tool_rnames[tool_id], rname, tool_id ) )
+        else:
+            tool_rnames[tool_id] = rname
+    return collisions
+
+
+def load_shards( shard_dirs ):
+    """Read the shard records in the --merge directories, each the --out of a --shard run, by package.
+
+    Returns a dict of r_name to a list of ( directory, shard record ), in shard order. Raises ValueError when
+    a package does not have exactly one of each of its N shards, when its shards were generated with
+    different options or package versions, or when functions of different shards render to the same tool id."""
+    packages = {}
+    for shard_dir in shard_dirs:
+        if os.path.exists( os.path.join( shard_dir, SHARD_FILENAME ) ):
+            package_dirs = [ shard_dir ]
+        else:
+            package_dirs = [ os.path.join( shard_dir, name ) for name in sorted( os.listdir( shard_dir ) ) if os.path.exists( os.path.join( shard_dir, name, SHARD_FILENAME ) ) ]
+        if not package_dirs:
+            raise ValueError( "%s is not the output of a --shard run" % ( shard_dir ) )
+        for package_dir in package_dirs:
+            with open( os.path.join( package_dir, SHARD_FILENAME ) ) as fh:
+                record = json.load( fh )
+            if record.get( 'format' ) != SHARD_FORMAT:
+                raise ValueError( "%s is not a shard record in format %s" % ( os.path.join( package_dir, SHARD_FILENAME ), SHARD_FORMAT ) )
+            packages.setdefault( record['package_info']['r_name'], [] ).append( ( package_dir, record ) )
+    for r_name, shards in packages.items():
+        shards.sort( key=lambda shard: shard[1]['shard'] )
+        found = [ '%i/%i' % tuple( record['shard'] ) for package_dir, record in shards ]
+        expected = [ '%i/%i' % ( k, shards[0][1]['shard'][1] ) for k in range( 1, shards[0][1]['shard'][1] + 1 ) ]
+        if found != expected:
+            raise ValueError( "%s: expected the shards %s, got %s" % ( r_name, ', '.join( expected ), ', '.join( found ) ) )
+        # The output directory and snapshot path may differ between hosts, everything else goes into the tools
+        options = set( json.dumps( [ dict( ( key, value ) for key, value in record['package_info'].items() if key not in ( 'out', 'snapshot' ) ),
+                                     record['load_matrix_tool'], record['pipeline_functions'] is not None ], sort_keys=True ) for package_dir, record in shards )
+        if len( options ) > 1:
+            raise ValueError( "%s: the shards were generated with different options, package or generator versions" % ( r_name ) )
+        if shards[0][1]['pipeline_functions'] is not None and shards[0][1]['package_info']['generator_hash'] != get_generator_hash():
+            raise ValueError( "%s: the shards were generated by another version of the generator, which must render the pipeline tool" % ( r_name ) )
+        # Each shard only checked its own functions
+        tool_rnames = get_package_tool_ids( shards[0][1]['package_info'], shards[0][1]['load_matrix_tool'], shards[0][1]['pipeline_functions'] is not None )
+        collisions = []
+        for package_dir, record in shards:
+            for rname, tool_id in record['tools'].items():
+                collisions.extend( claim_tool_ids( tool_rnames, rname, [ tool_id ] ) )
+            for rname, tool_id in record['collection_tools'].items():
+                collisions.extend( claim_tool_ids( tool_rnames, "the collection tool of %s" % ( rname ), [ tool_id ] ) )
+        if collisions:
+            raise ValueError( "%s: %s" % ( r_name, '; '.join( collisions ) ) )
+    return packages
+
+
+def merge_package( r_name, shards, out_dir, archive=None ):
+    """Combine the shards of a package, as returned by load_shards(), into out_dir; returns a summary dict like generate_package().
+
+    The macros file and the load matrix tool, the same in every shard, are written once, and the pipeline
+    tool is rendered from the functions of all the shards. Without an archive writer, the manifest is the
+    union of the shards' ones, so that a later unsharded run into out_dir only regenerates what changed."""
+    print('Merging', len( shards ), 'shards of', r_name, 'into', out_dir)
+    package_info = dict( shards[0][1]['package_info'], out=out_dir )
+    if archive is None:
+        try:
+            os.makedirs( out_dir )
+        except os.error:
+            pass
+    with open( os.path.join( shards[0][0], "%s_macros.xml" % ( r_name ) ) ) as fh:
+        write_output( archive, os.path.join( out_dir, "%s_macros.xml" % ( r_name ) ), fh.read(), if_changed=True )
+    created = 0
+    unchanged = 0
+    if shards[0][1]['load_matrix_tool']:
+        with open( os.path.join( shards[0][0], "r_load_matrix.xml" ) ) as fh:
+            if write_output( archive, os.path.join( out_dir, "r_load_matrix.xml" ), fh.read(), if_changed=True ):
+                created += 1
+            else:
+                unchanged += 1
+    tools = {}
+    collection_tools = {}
+    for package_dir, record in shards:
+        for rname, tool_id, paths in [ ( rname, tool_id, tools ) for rname, tool_id in record['tools'].items() ] + [ ( rname, tool_id, collection_tools ) for rname, tool_id in record['collection_tools'].items() ]:
+            path = os.path.join( out_dir, "%s.xml" % ( tool_id ) )
+            with open( os.path.join( package_dir, "%s.xml" % ( tool_id ) ) ) as fh:
+                if write_output( archive, path, fh.read(), if_changed=True ):
+                    print("Created: %s" % ( path ))
+                    created += 1
+                else:
+                    print("Unchanged: %s" % ( path ))
+                    unchanged += 1
+            paths[rname] = path
+    if shards[0][1]['pipeline_functions'] is not None:
+        # By name in code point order, as in generate_package()
+        pipeline_functions = sorted( ( function_info for package_dir, record in shards for function_info in record['pipeline_functions'] ), key=lambda function_info: function_info['rname'] )
+        if pipeline_functions:
+            pipeline_id, pipeline_xml = render_pipeline_tool_xml( pipeline_functions, package_info )
+            if write_output( archive, os.path.join( out_dir, "%s.xml" % ( pipeline_id ) ), pipeline_xml, if_changed=True ):
+                print("Created: %s" % ( os.path.join( out_dir, "%s.xml" % ( pipeline_id ) ) ))
+                created += 1
+            else:
+                print("Unchanged: %s" % ( os.path.join( out_dir, "%s.xml" % ( pipeline_id ) ) ))
+                unchanged += 1
+    if archive is None:
+        manifest = {}
+        for package_dir, record in shards:
+            manifest.update( ( rname, entry ) for rname, entry in load_manifest( package_dir, package_info ).items() if rname in record['tools'] )
+        write_manifest( out_dir, package_info, manifest )
+    skipped = sum( record['skipped'] for package_dir, record in shards )
+    print('')
+    print('created', created, 'tool XMLs')
+    print('unchanged', unchanged, 'tool XMLs')
+    print('skipped', skipped, 'functions')
+    return dict( r_name=r_name, out=out_dir, created=created, unchanged=unchanged, skipped=skipped, error=None,
+                 package_version=package_info['package_version'], tools=tools, collection_tools=collection_tools )
+
+
+def read_packages_file( path ):
+    """Read a batch file listing one package per line as '--name NAME [--package_name ...] [--package_version ...]'."""
+    parser = argparse.ArgumentParser( prog=path, add_help=False )
+    parser.add_argument("--name", required=True )
+    parser.add_argument("--package_name", default=None)
+    parser.add_argument("--package_version", default=None)
+    packages = []
+    with open( path ) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line or line.startswith( '#' ):
+                continue
+            packages.append( vars( parser.parse_args( shlex.split( line ) ) ) )
+    return packages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--name", help="Package Name; repeat to generate several packages in one run", action='append', default=[] )
+    parser.add_argument("--packages", help="File listing one package per line as '--name NAME [--package_name NAME] [--package_version VERSION]'", default=None)
+    parser.add_argument("--package_name", help="[Conda] Package Name", default=None)
+    parser.add_argument("--package_version", help="[Conda] Package Version", default=None)
+    parser.add_argument("--out", help="Output directory; with several packages each gets a subdirectory", default='out')
+    parser.add_argument("--archive", help="Write the tools, macros and an index into this tar archive (.tar or .tar.gz) instead of --out", default=None)
+    parser.add_argument("--include", help="Only generate the functions matching this fnmatch pattern, e.g. 'plot*'; repeatable", action='append', default=[])
+    parser.add_argument("--exclude", help="Do not generate the functions matching this fnmatch pattern; repeatable", action='append', default=[])
+    parser.add_argument("--functions_from", "--functions-from", help="Only generate the functions listed in this file, one per line", default=None)
+    parser.add_argument("--shard", help="Only generate shard K of N, e.g. 2/4, of the selected functions, split by a hash of their names, so N hosts can each generate one; combine their outputs with --merge", type=parse_shard, default=None)
+    parser.add_argument("--merge", help="Combine the --out directories of the N --shard runs into --out or --archive; repeat for each shard", action='append', default=[])
+    parser.add_argument("--inventory", help="Only list the exports of the packages with their kind, and whether they are selected, as tab separated values", action='store_true')
+    parser.add_argument("--create_load_matrix_tool", help="Output a tool that will create an RDS from a tabular matrix", action='store_true')
+    parser.add_argument("--create_pipeline_tool", help="Output a tool that chains several functions of the package in a single R session", action='store_true')
+    parser.add_argument("--create_collection_tools", help="Also output a variant of each function tool mapping it over a list collection of RDS datasets in a single R session", action='store_true')
+    parser.add_argument("--compact_xml", help="Expand the inputs of each tool from parameterized macros instead of inlining them; requires Galaxy 20.09 or later", action='store_true')
+    parser.add_argument("--release_inputs", help="In the generated scripts, drop the references to the input datasets once the function returns, before its result is saved", action='store_true')
+    parser.add_argument("--cache_dir", help="Cache the results of the function tools in this directory, keyed on the call, versions and input contents; R2G2_CACHE_DIR overrides it when the tools run", default=None)
+    parser.add_argument("--cache_max_size", help="Size of the result cache in MB, beyond which the least recently used results are evicted", type=int, default=10240)
+    parser.add_argument("--galaxy_tool_version", help="Additional Galaxy Tool Version", default='0.0.1')
+    parser.add_argument("--jobs", help="Number of worker processes, each with its own R session", type=int, default=1)
+    parser.add_argument("--function_timeout", help="Render each function in a supervised worker process, killed and replaced when it takes longer than this many seconds or crashes; the function is skipped", type=float, default=None)
+    parser.add_argument("--rds_version", help="Default RDS serialization format version of the generated tools", type=int, choices=RDS_VERSIONS, default=2)
+    parser.add_argument("--rds_compress", help="Default RDS compression of the generated tools", choices=RDS_COMPRESSIONS, default='gzip')
+    parser.add_argument("--rds_compression_level", help="Default RDS compression level of the generated tools", type=int, choices=RDS_COMPRESSION_LEVELS, default=6)
+    parser.add_argument("--force", help="Regenerate every tool, ignoring the manifest of a previous run in the output directory", action='store_true')
+    parser.add_argument("--timings", help="Write per-function stage timings to this file, as CSV if it ends with .csv, JSON otherwise", default=None)
+    parser.add_argument("--profile", help="Profile the run (not --jobs workers) with cProfile and dump the stats to this file", default=None)
+    parser.add_argument("--extract", help="Only extract the packages' functions, formals and help from R into this snapshot file (.json or .json.gz)", default=None)
+    parser.add_argument("--render", help="Render the tools from a snapshot written by --extract, without R; all its packages unless --name/--packages are given", default=None)
+    parser.add_argument("--serve", help="Run a server on this Unix socket that keeps R, and the functions and help of the packages asked for, in memory for --server runs; the --name/--packages given are loaded at start", default=None)
+    parser.add_argument("--server", help="Get the functions and help of the packages from the --serve server on this Unix socket instead of starting R; the tools are rendered by this run", default=None)
+    parser.add_argument("--invalidate", help="With --server, make the server forget the packages given, or all of them, and unload them from R, e.g. after reinstalling them", action='store_true')
+
+    args = parser.parse_args()
+
+    packages = [ dict( name=name, package_name=args.package_name, package_version=args.package_version ) for name in args.name ]
+    if args.packages:
+        packages.extend( read_packages_file( args.packages ) )
+    if args.serve:
+        if args.server or args.merge or args.render:
+            parser.error( "--serve only takes the packages to load at start" )
+        try:
+            serve( args.serve, [ package_args['name'] for package_args in packages ] )
+        except ValueError as e:
+            parser.error( str( e ) )
+        return
+    if not args.server:
+        if args.invalidate:
+            parser.error( "--invalidate requires --server" )
+        run( parser, args, packages )
+        return
+    if args.render or args.merge:
+        parser.error( "--server can not be combined with --render or --merge" )
+    if not packages and not args.invalidate:
+        parser.error( "at least one --name or a --packages file is required" )
+    if args.invalidate:
+        request = dict( command='invalidate', r_names=[ package_args['name'] for package_args in packages ] )
+    elif args.inventory:
+        # Every export, not only the functions an extract request would select
+        request = dict( command='inventory', r_names=[ package_args['name'] for package_args in packages ] )
+    else:
+        function_filter = dict( includes=args.include, excludes=args.exclude, names=read_functions_file( args.functions_from ) if args.functions_from else None, shard=args.shard )
+        request = dict( command='extract', r_names=[ package_args['name'] for package_args in packages ], function_filter=function_filter )
+    try:
+        reply = request_server( args.server, request )
+    except ( OSError, ValueError ) as e:
+        parser.error( "%s: %s" % ( args.server, e ) )
+    if args.invalidate:
+        print('invalidated', ' '.join( reply['invalidated'] ) or 'nothing')
+        return
+    if args.inventory:
+        function_filter = FunctionFilter( args.include, args.exclude, read_functions_file( args.functions_from ) if args.functions_from else None, args.shard )
+        for package_args, inventory in zip( packages, reply['inventories'] ):
+            print_inventory( package_args['name'], inventory, function_filter )
+        return
+    if args.extract:
+        write_snapshot( args.extract, reply['packages'] )
+        print('extracted', len( packages ), 'packages to', args.extract)
+        return
+    # The rest of the run is a --render of what the server extracted, so --jobs workers can load it too
+    server_dir = tempfile.mkdtemp( prefix='r2g2_server_' )
+    try:
+        args.render = os.path.join( server_dir, 'snapshot.json' )
+        write_snapshot( args.render, reply['packages'] )
+        run( parser, args, packages )
+    finally:
+        shutil.rmtree( server_dir, ignore_errors=True )
+
+
+def run( parser, args, packages ):
+    """Everything but --serve/--server: --inventory, --extract, --merge, or generate the packages."""
+    if args.extract and args.render:
+        parser.error( "--extract and --render can not be combined" )
+    if args.render and not packages:
+        packages = [ dict( name=name, package_name=None, package_version=None ) for name in sorted( load_snapshot( args.render ) ) ]
+    if args.merge and ( packages or args.shard or args.inventory or args.extract or args.render ):
+        parser.error( "--merge only combines the outputs of --shard runs, the packages and options come from them" )
+    if not packages and not args.merge:
+        parser.error( "at least one --name or a --packages file is required" )
+    if args.shard and args.archive:
+        parser.error( "--shard writes to --out, --merge can write the combined shards to --archive" )
+    if args.render:
+        for package_args in packages:
+            if package_args['name'] not in load_snapshot( args.render ):
+                parser.error( "%s is not in the snapshot %s" % ( package_args['name'], args.render ) )
+    args.function_filter = FunctionFilter( args.include, args.exclude, read_functions_file( args.functions_from ) if args.functions_from else None, args.shard )
+    if args.inventory:
+        for package_args in packages:
+            if args.render:
+                inventory = [ ( function_info['rname'], 'function' ) for function_info in load_snapshot( args.render )[package_args['name']]['functions'] ]
+            else:
+                inventory = inventory_package( package_args['name'] )
+            print_inventory( package_args['name'], inventory, args.function_filter )
+        return
+    if args.extract:
+        write_snapshot( args.extract, [ extract_package( package_args['name'], args.function_filter ) for package_args in packages ] )
+        print('extracted', len( packages ), 'packages to', args.extract)
+        return
+    if len( args.name ) > 1 and ( args.package_name or args.package_version ):
+        parser.error( "--package_name and --package_version apply to a single --name; use a --packages file for several packages" )
+    for package_args in packages:
+        if args.archive:
+            package_args['out'] = package_args['name'] if len( packages ) > 1 else ''
+        elif len( packages ) > 1:
+            package_args['out'] = os.path.join( args.out, package_args['name'] )
+        else:
+            package_args['out'] = args.out
+    shards = {}
+    if args.merge:
+        try:
+            shards = load_shards( args.merge )
+        except ( IOError, ValueError ) as e:
+            parser.error( str( e ) )
+    merge_out = {}
+    for r_name in shards:
+        if args.archive:
+            merge_out[r_name] = r_name if len( shards ) > 1 else ''
+        else:
+            merge_out[r_name] = os.path.join( args.out, r_name ) if len( shards ) > 1 else args.out
+
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.function_timeout:
+        pool = SupervisedWorkers( max( 1, args.jobs ), args.function_timeout )
+    else:
+        pool = create_pool( args.jobs )
+    archive = ThreadedWriter( ArchiveWriter( args.archive ) ) if args.archive else None
+    package_help_cache = {}
+    summaries = []
+    timing_records = []
+    try:
+        for r_name in sorted( shards ):
+            summaries.append( merge_package( r_name, shards[r_name], merge_out[r_name], archive ) )
+        for package_args in packages:
+            try:
+                summaries.append( generate_package( package_args, args, pool, package_help_cache, timing_records, archive ) )
+            except Exception as e:
+                # e.g. a package that is not installed or fails to load; the other packages are still generated
+                print('Failed to generate %s: %s' % ( package_args['name'], e ))
+                if isinstance( pool, SupervisedWorkers ):
+                    pool.reset()
+                summaries.append( dict( r_name=package_args['name'], out=package_args['out'], created=0, unchanged=0, skipped=0, error=str( e ),
+                                        package_version=None, tools={}, collection_tools={} ) )
+        if archive is not None:
+            index = dict( format=INDEX_FORMAT,
+                          packages=[ dict( r_name=summary['r_name'], package_version=summary['package_version'], directory=summary['out'], tools=summary['tools'], collection_tools=summary['collection_tools'] )
+                                     for summary in summaries if summary['error'] is None ] )
+            archive.write( INDEX_FILENAME, json.dumps( index, indent=1, sort_keys=True ) )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if archive is not None:
+            archive.close()
+            print('wrote', args.archive)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats( args.profile )
+    if args.timings:
+        write_timings( args.timings, timing_records )
+    if profiler is not None:
+        print('')
+        pstats.Stats( profiler ).sort_stats( 'cumulative' ).print_stats( 25 )
+
+    if len( summaries ) > 1:
+        print('')
+        for summary in summaries:
+            if summary['error'] is not None:
+                print('%(r_name)s: failed: %(error)s' % summary)
+            else:
+                print('%(r_name)s: created %(created)i, unchanged %(unchanged)i, skipped %(skipped)i (%(out)s)' % summary)
+        print('total created', sum( summary['created'] for summary in summaries ), 'tool XMLs')
+        print('total unchanged', sum( summary['unchanged'] for summary in summaries ), 'tool XMLs')
+        print('total skipped', sum( summary['skipped'] for summary in summaries ), 'functions')
+    failed = [ summary['r_name'] for summary in summaries if summary['error'] is not None ]
+    if failed:
+        parser.exit( 1, "failed to generate %s\n" % ( ', '.join( failed ) ) )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+"""Benchmark the execution of generated tools with Rscript, without a Galaxy server.
+
+Each tool of an output directory of r2g2_on_package.py is rendered the way Galaxy would
+(macros expanded, Cheetah command and configfile filled in with the default parameter values,
+optionally overridden from a params file), run against a small fixture RDS dataset, and one
+JSON record per run is appended to the results file, so that serialization settings, package
+versions and template changes can be compared on actual execution cost."""
+
+import argparse
+import copy
+import fnmatch
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+from r2g2_benchmark import GENERATOR, get_commit, get_r_version, wait_for_process
+
+# A small data.frame; passed to every rds data input without a value in the params file
+FIXTURE_RSCRIPT = 'saveRDS( data.frame( a = 1:10, b = seq( 0.5, 5, by = 0.5 ), c = letters[1:10] ), file = commandArgs( TRUE )[1], version = 2 )'
+
+# Signatures of the functions --check generates tools for; formals as stored by r2g2_on_package.py --extract:
+# name, SEXP type, length, first value, deparsed and printed default
+CHECK_FUNCTIONS = [
+    # f( x, BPPARAM = bpparam(), ... ), the usual Bioconductor signature
+    # f( x, ... ), ... right after the dataset a collection tool maps over
+    ( 'check.ellipsis', [ [ 'x', 'SYMSXP', 1, None, '', '$x\n\n' ],
+                          [ '...', 'SYMSXP', 1, None, '', '$...\n\n' ] ] ),
+    # f( x, how = c( "a", "b" ), ... ), an input of undetermined type that may be skipped
+    ( 'check.not_determined', [ [ 'x', 'SYMSXP', 1, None, '', '$x\n\n' ],
+                                [ 'how', 'LANGSXP', 2, None, 'c("a", "b")', '$how\nc("a", "b")\n' ],
+                                [ '...', 'SYMSXP', 1, None, '', '$...\n\n' ] ] ),
+    ( 'check.bpparam', [ [ 'x', 'SYMSXP', 1, None, '', '$x\n\n' ],
+                         [ 'BPPARAM', 'LANGSXP', 2, None, 'bpparam()', '$BPPARAM\nbpparam()\n' ],
+                         [ '...', 'SYMSXP', 1, None, '', '$...\n\n' ] ] ),
+]
+CHECK_GENERATOR_ARGS = [ [ '--create_collection_tools', '--create_pipeline_tool' ], [ '--create_collection_tools', '--create_pipeline_tool', '--compact_xml' ] ]
+# Elements of the collection passed to data_collection inputs
+FIXTURE_COLLECTION_SIZE = 2
+
+
+class FixtureElement( object ):
+    """A dataset of the fixture collection, as Cheetah sees the elements of a data_collection parameter."""
+
+    def __init__( self, identifier, path ):
+        self.element_identifier = identifier
+        self.path = path
+
+    def __str__( self ):
+        return self.path
+
+
+def load_macros( tool_dir, tool ):
+    """xml macros and tokens of the files imported by tool, by name."""
+    xml_macros = {}
+    tokens = {}
+    for imported in tool.findall( 'macros/import' ):
+        macros = ET.parse( os.path.join( tool_dir, imported.text.strip() ) ).getroot()
+        for macro in macros.findall( 'xml' ):
+            xml_macros[macro.get( 'name' )] = macro
+        for token in macros.findall( 'token' ):
+            tokens[token.get( 'name' )] = token.text or ''
+    for macro in tool.findall( 'macros/xml' ):
+        xml_macros[macro.get( 'name' )] = macro
+    for token in tool.findall( 'macros/token' ):
+        tokens[token.get( 'name' )] = token.text or ''
+    return xml_macros, tokens
+
+
+def replace_tokens( text, tokens ):
+    if text is None:
+        return text
+    for name, value in tokens.items():
+        text = text.replace( name, value )
+    return text
+
+
+def expand_macros( element, xml_macros, tokens ):
+    """Replace each <expand> below element by its macro, with the macro's tokens filled in, as Galaxy does."""
+    for child in list( element ):
+        if child.tag != 'expand':
+            expand_macros( child, xml_macros, tokens )
+            continue
+        macro = xml_macros[child.get( 'macro' )]
+        macro_tokens = dict( ( '@%s@' % ( key[len( 'token_' ):].upper() ), value ) for key, value in macro.attrib.items() if key.startswith( 'token_' ) )
+        macro_tokens.update( ( '@%s@' % ( key.upper() ), value ) for key, value in child.attrib.items() if key != 'macro' )
+        position = list( element ).index( child )
+        element.remove( child )
+        for offset, expanded in enumerate( copy.deepcopy( list( macro ) ) ):
+            for descendant in expanded.iter():
+                descendant.attrib = dict( ( key, replace_tokens( value, macro_tokens ) ) for key, value in descendant.attrib.items() )
+                descendant.text = replace_tokens( descendant.text, macro_tokens )
+            element.insert( position + offset, expanded )
+        expand_macros( element, xml_macros, tokens )
+        return
+
+
+def get_default_values( element, fixture, missing=None, prefix='' ):
+    """Default values of the inputs below element, nested as Cheetah sees them (conditionals, repeats and sections as dicts and lists).
+
+    rds data inputs get the fixture, collections FIXTURE_COLLECTION_SIZE elements of it. Other data inputs
+    get None, and the dotted paths of the required ones are appended to missing."""
+    values = {}
+    for child in element:
+        name = child.get( 'name' )
+        if child.tag == 'param':
+            param_type = child.get( 'type' )
+            if param_type == 'boolean':
+                checked = child.get( 'checked', 'false' ).lower() in ( 'true', 'yes' )
+                values[name] = child.get( 'truevalue', 'true' ) if checked else child.get( 'falsevalue', 'false' )
+            elif param_type == 'select':
+                options = child.findall( 'option' )
+                selected = [ option.get( 'value' ) for option in options if option.get( 'selected', 'false' ).lower() in ( 'true', 'yes' ) ]
+                if not selected and options and child.get( 'multiple', 'false' ).lower() not in ( 'true', 'yes' ):
+                    selected = [ options[0].get( 'value' ) ]
+                values[name] = ','.join( selected )
+            elif param_type == 'data':
+                if 'rds' in child.get( 'format', '' ).split( ',' ):
+                    values[name] = fixture
+                else:
+                    # e.g. the tabular input of r_load_matrix, which the fixture is not
+                    values[name] = None
+                    if missing is not None and child.get( 'optional', 'false' ).lower() not in ( 'true', 'yes' ):
+                        missing.append( prefix + name )
+            elif param_type == 'data_collection':
+                values[name] = [ FixtureElement( 'element_%i' % ( i + 1 ), fixture ) for i in range( FIXTURE_COLLECTION_SIZE ) ]
+            else:
+                values[name] = child.get( 'value', '' )
+        elif child.tag == 'conditional':
+            test = child.find( 'param' )
+            conditional = get_default_values( [ test ], fixture, missing, '%s%s.' % ( prefix, name ) )
+            for when in child.findall( 'when' ):
+                if when.get( 'value' ) == conditional[test.get( 'name' )]:
+                    conditional.update( get_default_values( when, fixture, missing, '%s%s.' % ( prefix, name ) ) )
+            values[name] = conditional
+        elif child.tag == 'repeat':
+            values[name] = [ get_default_values( child, fixture, missing, '%s%s.%i.' % ( prefix, name, i ) ) for i in range( int( child.get( 'default', child.get( 'min', 0 ) ) ) ) ]
+        elif child.tag == 'section':
+            values[name] = get_default_values( child, fixture, missing, '%s%s.' % ( prefix, name ) )
+    return values
+
+
+def set_value( values, path, value ):
+    """Set a dotted path, e.g. 'x_type.x_type.x' or 'steps.0.step.step_function', in nested values."""
+    keys = path.split( '.' )
+    for key in keys[:-1]:
+        values = values[int( key )] if isinstance( values, list ) else values[key]
+    if isinstance( values, list ):
+        values[int( keys[-1] )] = value
+    else:
+        values[keys[-1]] = value
+
+
+def render_tool( tool_path, run_dir, fixture, params ):
+    """Render the command of a tool, and write its configfiles into run_dir; returns ( tool id, command, output paths ).
+
+    Raises ValueError when a required data input can not take the fixture and has no value in params."""
+    from Cheetah.Template import Template
+    tool_dir = os.path.dirname( tool_path )
+    tool = ET.parse( tool_path ).getroot()
+    xml_macros, tokens = load_macros( tool_dir, tool )
+    inputs = tool.find( 'inputs' )
+    expand_macros( inputs, xml_macros, tokens )
+    missing = []
+    values = get_default_values( inputs, fixture, missing )
+    missing = [ path for path in missing if path not in params ]
+    if missing:
+        raise ValueError( "no fixture for the data inputs %s, give them a dataset in --params" % ( ', '.join( missing ) ) )
+    for path, value in params.items():
+        set_value( values, path, value )
+    outputs = {}
+    for output in tool.find( 'outputs' ):
+        if output.tag == 'data':
+            outputs[output.get( 'name' )] = os.path.join( run_dir, '%s.%s' % ( output.get( 'name' ), output.get( 'format', 'data' ) ) )
+    values.update( outputs )
+    for output in tool.find( 'outputs' ).findall( 'collection' ):
+        discover = output.find( 'discover_datasets' )
+        if discover is not None:
+            outputs[output.get( 'name' )] = os.path.join( run_dir, discover.get( 'directory', '' ) )
+    for configfile in tool.findall( 'configfiles/configfile' ):
+        values[configfile.get( 'name' )] = os.path.join( run_dir, '%s.R' % ( configfile.get( 'name' ) ) )
+    for configfile in tool.findall( 'configfiles/configfile' ):
+        with open( values[configfile.get( 'name' )], 'w' ) as out:
+            out.write( str( Template( replace_tokens( configfile.text, tokens ), searchList=[ values ] ) ) )
+    command = str( Template( replace_tokens( tool.find( 'command' ).text, tokens ), searchList=[ values ] ) )
+    return tool.get( 'id' ), command, outputs
+
+
+def check_rendering( work_dir ):
+    """Generate the tools of CHECK_FUNCTIONS from a snapshot, without R, with each of CHECK_GENERATOR_ARGS, and render them
+    with their default values, without running them; returns the failures as ( generator arguments, tool, error )."""
+    snapshot = os.path.join( work_dir, 'check_snapshot.json' )
+    with open( snapshot, 'w' ) as out:
+        json.dump( dict( format=1, packages=[ dict( r_name='r2g2check', version='0.0.1', help={},
+                                                    functions=[ dict( rname=rname, rd=None, formals=formals ) for rname, formals in CHECK_FUNCTIONS ] ) ] ), out )
+    failures = []
+    for i, generator_args in enumerate( CHECK_GENERATOR_ARGS ):
+        out_dir = os.path.join( work_dir, 'check_%i' % ( i ) )
+        subprocess.check_call( [ sys.executable, GENERATOR, '--render', snapshot, '--out', out_dir ] + generator_args, stdout=subprocess.DEVNULL )
+        for name in sorted( name for name in os.listdir( out_dir ) if name.endswith( '.xml' ) and not name.endswith( '_macros.xml' ) ):
+            run_dir = os.path.join( work_dir, 'check_%i_%s' % ( i, name[:-len( '.xml' )] ) )
+            os.makedirs( run_dir )
+            try:
+                render_tool( os.path.join( out_dir, name ), run_dir, os.path.join( work_dir, 'fixture.rds' ), {} )
+            except Exception as e:
+                failures.append( ( ' '.join( generator_args ), name, str( e ).strip().split( '\n' )[0] ) )
+                print('%s %s: could not render: %s' % ( name, ' '.join( generator_args ), e ))
+            else:
+                print('%s %s: rendered' % ( name, ' '.join( generator_args ) ))
+    return failures
+
+
+def get_size( path ):
+    if os.path.isdir( path ):
+        return sum( get_size( os.path.join( path, name ) ) for name in os.listdir( path ) )
+    return os.path.getsize( path ) if os.path.exists( path ) else 0
+
+
+def run_command( command, run_dir, timeout, slots=1 ):
+    """Run a rendered command in run_dir with slots GALAXY_SLOTS; returns ( exit code, wall time, peak RSS in KB, stderr tail )."""
+    env = dict( os.environ, GALAXY_SLOTS=str( slots ) )
+    start = time.time()
+    stderr_path = os.path.join( run_dir, 'stderr.txt' )
+    with open( stderr_path, 'w' ) as stderr:
+        proc = subprocess.Popen( [ '/bin/sh', '-c', command ], cwd=run_dir, env=env, stdout=subprocess.DEVNULL, stderr=stderr )
+        returncode, peak_rss = wait_for_process( proc, timeout )
+    wall = time.time() - start
+    with open( stderr_path ) as fh:
+        stderr_tail = fh.read()[-2000:]
+    return returncode, wall, peak_rss, stderr_tail
+
+
+def main():
+    parser = argparse.ArgumentParser( description=__doc__.split( '\n' )[0] )
+    parser.add_argument("tools", help="Output directory of r2g2_on_package.py", nargs='?', default=None)
+    parser.add_argument("--match", help="Only run the tool files matching this pattern", default='*.xml')
+    parser.add_argument("--params", help="JSON file of parameter values by tool id, '*' for every tool, each a dict of dotted parameter paths, e.g. {\"*\": {\"rds_options.rds_compress\": \"none\"}}", default=None)
+    parser.add_argument("--fixture", help="RDS file passed to rds data inputs; by default a small data.frame is created with Rscript", default=None)
+    parser.add_argument("--repeat", help="Runs per tool", type=int, default=3)
+    parser.add_argument("--timeout", help="Seconds after which a run is killed", type=float, default=600)
+    parser.add_argument("--slots", help="GALAXY_SLOTS of the runs, i.e. the cores the tools may use", type=int, default=1)
+    parser.add_argument("--label", help="Free text label stored with each record", default='')
+    parser.add_argument("--output", help="JSON lines file the results are appended to", default='r2g2_tool_benchmark.jsonl')
+    parser.add_argument("--keep", help="Keep the rendered scripts and outputs", action='store_true')
+    parser.add_argument("--check", help="Instead of running the tools, only check that the tools generated for a set of signatures known to have broken the templates render; needs neither R nor Rscript", action='store_true')
+    args = parser.parse_args()
+
+    try:
+        import Cheetah.Template # noqa: F401
+    except ImportError:
+        parser.error( "Cheetah3 is needed to render the tools: pip install Cheetah3" )
+    if args.check:
+        work_dir = tempfile.mkdtemp( prefix='r2g2_tool_check_' )
+        try:
+            failures = check_rendering( work_dir )
+        finally:
+            shutil.rmtree( work_dir, ignore_errors=True )
+        print('%i tools could not be rendered' % ( len( failures ) ))
+        sys.exit( 1 if failures else 0 )
+    if args.tools is None:
+        parser.error( "the output directory of r2g2_on_package.py is required, unless --check" )
+    params = {}
+    if args.params:
+        with open( args.params ) as fh:
+            params = json.load( fh )
+    commit = get_commit()
+    r_version = get_r_version()
+
+    work_dir = tempfile.mkdtemp( prefix='r2g2_tool_benchmark_' )
+    try:
+        fixture = args.fixture
+        if fixture is None:
+            fixture = os.path.join( work_dir, 'fixture.rds' )
+            subprocess.check_call( [ 'Rscript', '-e', FIXTURE_RSCRIPT, fixture ] )
+        fixture = os.path.abspath( fixture )
+        names = sorted( name for name in os.listdir( args.tools ) if fnmatch.fnmatch( name, args.match ) and name.endswith( '.xml' ) and not name.endswith( '_macros.xml' ) )
+        for name in names:
+            tool_path = os.path.join( args.tools, name )
+            for run in range( args.repeat ):
+                run_dir = os.path.join( work_dir, '%s_%i' % ( name[:-len( '.xml' )], run ) )
+                os.makedirs( run_dir )
+                record = dict( timestamp=time.strftime( '%Y-%m-%dT%H:%M:%S' ),
+                               commit=commit,
+                               label=args.label,
+                               python=platform.python_version(),
+                               r=r_version,
+                               tool=name,
+                               slots=args.slots,
+                               run=run )
+                try:
+                    tool_id, command, outputs = render_tool( tool_path, run_dir, fixture, dict( params.get( '*', {} ), **params.get( name[:-len( '.xml' )], {} ) ) )
+                except Exception as e:
+                    record.update( id=None, returncode=None, error='render: %s' % ( e ) )
+                    print('%s: could not render: %s' % ( name, e ))
+                else:
+                    returncode, wall, peak_rss, stderr_tail = run_command( command, run_dir, args.timeout, args.slots )
+                    record.update( id=tool_id,
+                                   returncode=returncode,
+                                   wall_seconds=round( wall, 4 ),
+                                   peak_rss_kb=peak_rss,
+                                   output_bytes=dict( ( output, get_size( path ) ) for output, path in outputs.items() ),
+                                   error=stderr_tail if returncode else None )
+                    print('%(tool)s, run %(run)i: exit %(returncode)s, %(wall_seconds).2fs, %(peak_rss_kb)i KB' % record)
+                with open( args.output, 'a' ) as out:
+                    out.write( '%s\n' % ( json.dumps( record, sort_keys=True ) ) )
+                if not args.keep:
+                    shutil.rmtree( run_dir, ignore_errors=True )
+    finally:
+        if args.keep:
+            print('Kept', work_dir)
+        else:
+            shutil.rmtree( work_dir, ignore_errors=True )
+
+
+if __name__ == '__main__':
+    main()